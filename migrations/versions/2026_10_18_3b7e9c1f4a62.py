@@ -0,0 +1,32 @@
+"""
+Add user name pattern index.
+
+Revision ID: 3b7e9c1f4a62
+Revises: 8d4f2b6a1e93
+
+"""
+
+from collections.abc import Sequence
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3b7e9c1f4a62'
+down_revision: str | None = '8d4f2b6a1e93'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # LIKE 'prefix%' can only use a btree index with byte-wise ordering unless the database collation is C
+    op.create_index(
+        'ix_user_name_pattern',
+        'user',
+        ['name'],
+        unique=False,
+        postgresql_ops={'name': 'text_pattern_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_name_pattern', table_name='user')
@@ -1,6 +1,55 @@
+import os
+
+
+def serve(shard: int | None = None) -> None:
+    if shard is not None:
+        # read by the settings when the app is imported, a log file per shard
+        os.environ['WS_SHARD'] = str(shard)
+        os.environ['LAUNCH_FILE'] = f'server-{shard}'
+
+    # only once the environment above is set, the settings and every singleton are built on import
+    import uvicorn  # noqa: PLC0415
+
+    from tdb.poc_websockets.server import app  # noqa: PLC0415
+    from tdb.poc_websockets.server.config import settings  # noqa: PLC0415
+    from tdb.poc_websockets.server.drain import DrainingServer  # noqa: PLC0415
+    from tdb.poc_websockets.server.shards import shard_port  # noqa: PLC0415
+
+    config = uvicorn.Config(
+        app.app,
+        host='localhost',
+        port=shard_port(settings.WS_SHARD),
+        log_level='debug',
+        ws_ping_interval=settings.WS_PROTOCOL_PING_INTERVAL_SECONDS,
+        ws_ping_timeout=settings.WS_PROTOCOL_PING_TIMEOUT_SECONDS,
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE,
+    )
+    DrainingServer(config).run()
+
+
 if __name__ == '__main__':
-    import uvicorn
+    import multiprocessing
+    import signal
+    from types import FrameType
+
+    from tdb.poc_websockets.server.config import settings
+
+    if settings.WS_SHARDS > 1:
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=serve, args=(shard,)) for shard in range(settings.WS_SHARDS)]
+        for process in processes:
+            process.start()
+
+        def forward(sig: int, _frame: FrameType | None) -> None:
+            for process in processes:
+                if process.pid is not None and process.is_alive():
+                    os.kill(process.pid, sig)
 
-    from tdb.poc_websockets.server import app
+        # every shard drains on its own, ctrl+c already reaches the whole process group, SIGTERM is passed on
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, forward)
 
-    uvicorn.run(app.app, host='localhost', port=8000, log_level='debug')
+        for process in processes:
+            process.join()
+    else:
+        serve()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import random
+import time
+import zlib
+from collections.abc import Callable
+
+from tdb.poc_websockets.server.protocol import Envelope, WireFormat, encode
+from tdb.poc_websockets.server.websocket import encode_frame
+
+# Bytes on the wire versus CPU for one room broadcast of json-ish chat payloads.
+#   python -m tdb.poc_websockets.bench.compression --recipients 100 1000 --payload-size 128 1024
+# permessage-deflate is modelled as a compressor per recipient with context takeover, as uvicorn negotiates it.
+
+Strategy = Callable[[Envelope], int]
+
+
+def messages(size: int, count: int) -> list[Envelope]:
+    rng = random.Random(size)  # noqa: S311
+    vocabulary = ['hello', 'room', 'status', 'update', 'ready', 'typing', 'message', 'online', 'away', 'ok']
+
+    envelopes = []
+    for index in range(count):
+        words: list[str] = []
+        while len(json.dumps({'type': 'chat', 'index': index, 'words': words})) < size:
+            words.append(rng.choice(vocabulary))
+
+        payload = json.dumps({'type': 'chat', 'index': index, 'words': words}).encode('utf-8')
+        envelopes.append(Envelope.message(payload, room='bench', sender='sender@example.com'))
+
+    return envelopes
+
+
+def uncompressed(recipients: int) -> Strategy:
+    def broadcast(message: Envelope) -> int:
+        return len(encode(message)) * recipients
+
+    return broadcast
+
+
+def per_message_deflate(recipients: int, level: int) -> Strategy:
+    compressors = [zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS) for _ in range(recipients)]
+
+    def broadcast(message: Envelope) -> int:
+        frame = encode(message)
+
+        sent = 0
+        for compressor in compressors:
+            sent += len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+        return sent
+
+    return broadcast
+
+
+def deflate_envelopes(recipients: int) -> Strategy:
+    def broadcast(message: Envelope) -> int:
+        # compressed once, as deliver does per wire format
+        return len(encode_frame(message, WireFormat.DEFLATE)) * recipients
+
+    return broadcast
+
+
+def run(recipients: int, size: int, count: int, level: int) -> None:
+    envelopes = messages(size, count)
+
+    strategies = {
+        'uncompressed': uncompressed(recipients),
+        'permessage-deflate': per_message_deflate(recipients, level),
+        'deflate envelope': deflate_envelopes(recipients),
+    }
+
+    raw = sum(len(encode(message)) for message in envelopes) * recipients
+    for name, broadcast in strategies.items():
+        start = time.process_time()
+        sent = sum(broadcast(message) for message in envelopes)
+        elapsed = time.process_time() - start
+
+        per_broadcast = elapsed / count * 1_000_000
+        print(  # noqa: T201
+            f'{recipients:>6} recipients {size:>6}B {name:>18}: '
+            f'{sent / raw:6.1%} of raw bytes, {per_broadcast:10.1f} us cpu/broadcast',
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compression bytes versus cpu benchmark')
+    parser.add_argument('--recipients', type=int, nargs='+', default=[100, 1_000])
+    parser.add_argument('--payload-size', type=int, nargs='+', default=[64, 256, 1_024, 4_096])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--level', type=int, default=6, help='permessage-deflate level')
+    args = parser.parse_args()
+
+    for recipients in args.recipients:
+        for size in args.payload_size:
+            run(recipients, size, args.messages, args.level)
@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import secrets
+import statistics
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import aiohttp
+import bcrypt
+import uvicorn
+from starlette.status import HTTP_200_OK, HTTP_201_CREATED
+
+from tdb.poc_websockets.client.client import Client
+from tdb.poc_websockets.client.config import settings
+from tdb.poc_websockets.server import app
+from tdb.poc_websockets.server import auth as server_auth
+from tdb.poc_websockets.server.routes.v1 import user as user_routes
+
+# Throughput and latency of the /v1/users CRUD routes for every combination of pool settings, to size the pool from.
+#   python -m tdb.poc_websockets.bench.crud --pool-size 5 10 20 --max-overflow 0 10 --concurrency 50 200
+# Each combination gets a fresh server process, configured through the environment like any deployment. Needs a local
+# postgres, the bench users are created and deleted by the run itself. Passwords are hashed at the cheapest bcrypt
+# cost, so creates and updates measure the database rather than the hash pool.
+
+# operation weights, reads dominate as they do in practice
+OPERATIONS = {'read': 50, 'list': 20, 'update': 15, 'create': 10, 'delete': 5}
+
+random = secrets.SystemRandom()
+
+
+@dataclass
+class Stats:
+    started: float = field(default_factory=time.perf_counter)
+    finished: float = 0
+    errors: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    # server side, over the run
+    pool: dict[str, float] = field(default_factory=dict)
+
+
+# read from /status/metrics before and after each run
+POOL_METRICS = (
+    'db_pool_checkouts_total',
+    'db_pool_checkout_wait_seconds_sum',
+    'db_pool_timeouts_total',
+    'db_pool_connects_total',
+)
+
+
+def serve(host: str, port: int) -> None:
+    async def get_password_hash(password: str) -> str:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+
+    server_auth.get_password_hash = get_password_hash
+    uvicorn.run(app.app, host=host, port=port, log_level='warning')
+
+
+class CrudClient:
+    def __init__(self, session: aiohttp.ClientSession, stats: Stats, *, run: str) -> None:
+        self.session = session
+        self.stats = stats
+        self.run = run
+
+        client = Client()
+        self.users_uri = client.build_uri(settings.APP_SCHEMA, user_routes.router, user_routes.post.__name__)
+        self.idents: list[str] = []
+        self.created = itertools.count()
+
+    def user(self) -> dict[str, str]:
+        index = next(self.created)
+        return {'email': f'crud-{self.run}-{index}@example.com', 'name': f'crud {index}', 'password': 'bench'}
+
+    async def request(
+        self,
+        operation: str,
+        method: str,
+        uri: str,
+        *,
+        json: object = None,
+        params: dict[str, str] | None = None,
+    ) -> object:
+        start = time.perf_counter()
+        async with self.session.request(method, uri, json=json, params=params) as response:
+            body = await response.json() if response.status in {HTTP_200_OK, HTTP_201_CREATED} else None
+
+        if body is None:
+            self.stats.errors[operation] += 1
+        else:
+            self.stats.latencies[operation].append(time.perf_counter() - start)
+
+        return body
+
+    async def step(self, operation: str) -> None:
+        if operation in {'read', 'update', 'delete'} and not self.idents:
+            operation = 'create'
+
+        if operation == 'create':
+            body = await self.request(operation, 'POST', self.users_uri, json=self.user())
+            if isinstance(body, dict):
+                self.idents.append(body['id'])
+
+        elif operation == 'read':
+            await self.request(operation, 'GET', f'{self.users_uri}{random.choice(self.idents)}')
+
+        elif operation == 'list':
+            await self.request(operation, 'GET', self.users_uri, params={'name': 'crud', 'limit': '50'})
+
+        elif operation == 'update':
+            await self.request(operation, 'PATCH', f'{self.users_uri}{random.choice(self.idents)}', json=self.user())
+
+        else:
+            ident = self.idents.pop(random.randrange(len(self.idents)))
+            await self.request(operation, 'DELETE', f'{self.users_uri}{ident}')
+
+    async def cleanup(self) -> None:
+        if self.idents:
+            async with self.session.delete(f'{self.users_uri}bulk', json=self.idents):
+                pass
+
+
+async def wait_ready(session: aiohttp.ClientSession, uri: str) -> None:
+    for _ in range(100):
+        try:
+            async with session.get(uri) as response:
+                if response.status == HTTP_200_OK:
+                    return
+        except aiohttp.ClientConnectionError:
+            pass
+
+        await asyncio.sleep(0.1)
+
+    msg = 'Server did not start'
+    raise RuntimeError(msg)
+
+
+async def pool_metrics(session: aiohttp.ClientSession, uri: str) -> dict[str, float]:
+    async with session.get(uri) as response:
+        text = await response.text()
+
+    values = dict.fromkeys(POOL_METRICS, 0.0)
+    for line in text.splitlines():
+        name, _, value = line.partition(' ')
+        if name in values:
+            values[name] = float(value)
+
+    return values
+
+
+async def drive(args: argparse.Namespace, run: str) -> Stats:
+    operations, weights = list(OPERATIONS), list(OPERATIONS.values())
+    stats = Stats()
+
+    base = f'{settings.APP_SCHEMA}://{settings.APP_HOST}:{settings.APP_PORT}'
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_ready(session, f'{base}/status/health')
+        before = await pool_metrics(session, f'{base}/status/metrics')
+
+        clients = [CrudClient(session, stats, run=f'{run}-{index}') for index in range(args.concurrency)]
+        deadline = time.perf_counter() + args.duration
+
+        async def loop(client: CrudClient) -> None:
+            while time.perf_counter() < deadline:
+                await client.step(random.choices(operations, weights)[0])
+
+        stats.started = time.perf_counter()
+        await asyncio.gather(*(loop(client) for client in clients))
+        stats.finished = time.perf_counter()
+
+        after = await pool_metrics(session, f'{base}/status/metrics')
+        stats.pool = {name: after[name] - before[name] for name in POOL_METRICS}
+
+        await asyncio.gather(*(client.cleanup() for client in clients))
+
+    return stats
+
+
+def report(stats: Stats, *, pool_size: int, max_overflow: int, concurrency: int) -> None:
+    elapsed = max(stats.finished - stats.started, 1e-9)
+    total = sum(len(latencies) for latencies in stats.latencies.values())
+    errors = sum(stats.errors.values())
+
+    print(  # noqa: T201
+        f'pool {pool_size:>3}+{max_overflow:<3} concurrency {concurrency:>4}: '
+        f'{total / elapsed:8.0f} req/s, {errors} errors',
+    )
+
+    wait = stats.pool['db_pool_checkout_wait_seconds_sum'] / max(stats.pool['db_pool_checkouts_total'], 1)
+    timeouts, connects = stats.pool['db_pool_timeouts_total'], stats.pool['db_pool_connects_total']
+    print(  # noqa: T201
+        f'    pool: {wait * 1000:8.2f} ms mean checkout wait  {timeouts:.0f} timeouts  {connects:.0f} connects',
+    )
+
+    for operation in OPERATIONS:
+        latencies = stats.latencies.get(operation, [])
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+            print(  # noqa: T201
+                f'    {operation:>6}: p50 {quantiles[49] * 1000:8.2f} ms  p99 {quantiles[98] * 1000:8.2f} ms  '
+                f'{stats.errors.get(operation, 0)} errors',
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='/v1/users CRUD benchmark over pool settings')
+    parser.add_argument('--pool-size', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--max-overflow', type=int, nargs='+', default=[0, 10])
+    parser.add_argument('--pool-timeout', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--duration', type=float, default=20, help='seconds per combination')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    # emails are unique, left over users from an interrupted run must not collide
+    prefix = secrets.token_hex(3)
+
+    for pool_size, max_overflow in itertools.product(args.pool_size, args.max_overflow):
+        # inherited by the server process, which reads them when it imports the app
+        os.environ['POSTGRES_POOL_SIZE'] = str(pool_size)
+        os.environ['POSTGRES_MAX_OVERFLOW'] = str(max_overflow)
+        os.environ['POSTGRES_POOL_TIMEOUT_SECONDS'] = str(args.pool_timeout)
+
+        server = context.Process(target=serve, args=(settings.APP_HOST, settings.APP_PORT))
+        server.start()
+
+        try:
+            for concurrency in args.concurrency:
+                run_args = argparse.Namespace(concurrency=concurrency, duration=args.duration)
+                stats = asyncio.run(drive(run_args, f'{prefix}-{pool_size}-{max_overflow}-{concurrency}'))
+                report(stats, pool_size=pool_size, max_overflow=max_overflow, concurrency=concurrency)
+
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
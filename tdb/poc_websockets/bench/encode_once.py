@@ -0,0 +1,85 @@
+import argparse
+import time
+from typing import TYPE_CHECKING, cast
+
+from tdb.poc_websockets.server.broker import InMemoryBroker
+from tdb.poc_websockets.server.config import SlowConsumerPolicy
+from tdb.poc_websockets.server.history import create_history
+from tdb.poc_websockets.server.protocol import Envelope, WireFormat
+from tdb.poc_websockets.server.websocket import Connection, ConnectionManager, encode_frame
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from fastapi import WebSocket
+
+# CPU cost of one broadcast, encoding per recipient versus once per wire format.
+#   python -m tdb.poc_websockets.bench.encode_once --recipients 1000 10000
+
+
+def build(recipients: int, wire_format: WireFormat, rounds: int) -> ConnectionManager:
+    manager = ConnectionManager(
+        InMemoryBroker(),
+        create_history(),
+        queue_size=rounds + 1,
+        policy=SlowConsumerPolicy.DROP_NEWEST,
+    )
+
+    for index in range(recipients):
+        user = f'user-{index}@example.com'
+        # writers are never started, frames stay queued and no socket is touched
+        connection = Connection(
+            cast('WebSocket', None),
+            room='bench',
+            user=user,
+            wire_format=wire_format,
+            queue_size=manager.queue_size,
+            policy=manager.policy,
+        )
+        manager.registry.add(connection)
+
+    return manager
+
+
+def drain(manager: ConnectionManager) -> None:
+    for connection in manager.registry.room('bench'):
+        while not connection.queue.empty():
+            connection.queue.get_nowait()
+
+
+def per_recipient(manager: ConnectionManager, message: Envelope) -> None:
+    # what broadcast did before frames were shared
+    for connection in manager.registry.room(message.room):
+        connection.enqueue(encode_frame(message, connection.wire_format))
+
+
+def run(recipients: int, wire_format: WireFormat, rounds: int, payload: bytes) -> None:
+    manager = build(recipients, wire_format, rounds)
+    message = Envelope.message(payload, room='bench', sender='sender@example.com')
+
+    strategies: dict[str, Callable[[], None]] = {
+        'per recipient': lambda: per_recipient(manager, message),
+        'encode once': lambda: manager.deliver(message),
+    }
+
+    for name, broadcast in strategies.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            broadcast()
+        elapsed = time.perf_counter() - start
+        drain(manager)
+
+        per_broadcast = elapsed / rounds * 1_000_000
+        print(f'{wire_format:>6} {recipients:>6} recipients {name:>14}: {per_broadcast:10.1f} us/broadcast')  # noqa: T201
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode-once broadcast microbenchmark')
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1_000, 10_000])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--payload-size', type=int, default=256)
+    args = parser.parse_args()
+
+    for recipients in args.recipients:
+        for wire_format in WireFormat:
+            run(recipients, wire_format, args.rounds, b'x' * args.payload_size)
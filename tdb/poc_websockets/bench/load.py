@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import secrets
+import statistics
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+from starlette.status import HTTP_201_CREATED, HTTP_503_SERVICE_UNAVAILABLE
+
+from tdb.poc_websockets.bench import stub
+from tdb.poc_websockets.client.client import Client
+from tdb.poc_websockets.client.config import settings
+from tdb.poc_websockets.server.protocol import Envelope, Kind
+from tdb.poc_websockets.server.routes.v1 import user as user_routes
+
+# Load generator: thousands of binary protocol clients spread over worker processes.
+#   python -m tdb.poc_websockets.bench.load --sessions 5000 --topology huge --rate 2000
+#   python -m tdb.poc_websockets.bench.load --sessions 5000 --topology small --room-size 20 --serve-stub
+# Latency is receive time minus the timestamp the server gave each envelope. Drops are seq gaps, a session's own
+# messages are not echoed back but acknowledged with their seq, so they do not count as gaps.
+# Every session logs in and sends from this one address: a real server needs RATE_LIMIT_LOGIN_RATE, RATE_LIMIT_IP_RATE
+# and, for the huge topology, RATE_LIMIT_ROOM_RATE set to 0 (or far above the load), as --serve-stub does.
+
+# latency samples kept per process, a reservoir over everything received
+MAX_SAMPLES = 200_000
+
+random = secrets.SystemRandom()
+
+
+@dataclass
+class Stats:
+    sent: int = 0
+    received: int = 0
+    missed: int = 0
+    reconnects: int = 0
+    started: float = field(default_factory=time.time)
+    finished: float = 0
+    latencies: list[float] = field(default_factory=list)
+
+    def record(self, latency: float) -> None:
+        self.received += 1
+
+        if len(self.latencies) < MAX_SAMPLES:
+            self.latencies.append(latency)
+            return
+
+        slot = random.randrange(self.received)
+        if slot < MAX_SAMPLES:
+            self.latencies[slot] = latency
+
+    def merge(self, other: 'Stats') -> None:
+        self.sent += other.sent
+        self.received += other.received
+        self.missed += other.missed
+        self.reconnects += other.reconnects
+        self.started = min(self.started, other.started)
+        self.finished = max(self.finished, other.finished)
+        self.latencies.extend(other.latencies)
+
+
+class LoadClient(Client):
+    def __init__(self, index: int, room: str, *, args: argparse.Namespace, stats: Stats) -> None:
+        super().__init__(user=bench_user(index), password=args.password, room=room, binary=True, compress=args.compress)
+
+        self.stats = stats
+        self.interval = args.sessions / args.rate
+        self.duration = args.duration
+        self.payload = b'x' * args.payload_size
+
+        # replayed history arrives before SYNC and would skew latency
+        self.synced = asyncio.Event()
+
+    def track(self, envelope: Envelope) -> None:
+        if envelope.kind is Kind.SYNC:
+            if self.synced.is_set():
+                self.stats.reconnects += 1
+            self.synced.set()
+
+        missed = self.missed
+        super().track(envelope)
+        self.stats.missed += self.missed - missed
+
+    async def receive(self, message: str | Envelope) -> None:
+        if isinstance(message, Envelope) and message.kind is Kind.MESSAGE and self.synced.is_set():
+            self.stats.record(time.time() - message.timestamp)
+
+    async def generate_message(self) -> None:
+        await self.synced.wait()
+
+        # spread the first send so sessions do not tick in lockstep
+        await asyncio.sleep(self.random.uniform(0, self.interval))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.duration
+
+        while loop.time() < deadline:
+            await self.producer_queue.put(self.payload.decode('ascii'))
+            self.stats.sent += 1
+            await asyncio.sleep(self.interval)
+
+        await self.producer_queue.put(None)
+
+
+def bench_user(index: int) -> str:
+    return f'bench-{index}@example.com'
+
+
+def bench_room(index: int, args: argparse.Namespace) -> str:
+    if args.topology == 'huge':
+        return 'bench-huge'
+
+    return f'bench-small-{index // args.room_size}'
+
+
+async def run_sessions(indexes: range, args: argparse.Namespace) -> Stats:
+    stats = Stats()
+    tasks = []
+
+    for index in indexes:
+        client = LoadClient(index, bench_room(index, args), args=args, stats=stats)
+        tasks.append(asyncio.create_task(client.run()))
+
+        # ramp up, logins are bcrypt bound on the server
+        await asyncio.sleep(1 / args.ramp)
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    stats.finished = time.time()
+    return stats
+
+
+def worker(indexes: range, args: argparse.Namespace) -> Stats:
+    return asyncio.run(run_sessions(indexes, args))
+
+
+async def create_users(args: argparse.Namespace) -> None:
+    uri = Client().build_uri(settings.APP_SCHEMA, user_routes.router, user_routes.post.__name__)
+    semaphore = asyncio.Semaphore(16)
+
+    async def create(session: aiohttp.ClientSession, index: int) -> None:
+        data = {'email': bench_user(index), 'name': f'bench {index}', 'password': args.password}
+
+        async with semaphore:
+            while True:
+                async with session.post(uri, json=data) as response:
+                    # already existing users fail on the unique email, which is fine here
+                    if response.status != HTTP_503_SERVICE_UNAVAILABLE:
+                        if response.status != HTTP_201_CREATED:
+                            print(f'{bench_user(index)}: {response.status}')  # noqa: T201
+                        return
+
+                await asyncio.sleep(1)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(create(session, index) for index in range(args.sessions)))
+
+
+def report(stats: Stats, args: argparse.Namespace) -> None:
+    elapsed = max(stats.finished - stats.started, 1e-9)
+
+    print(f'sessions:     {args.sessions} ({args.topology}, {args.processes} processes)')  # noqa: T201
+    print(f'sent:         {stats.sent} ({stats.sent / elapsed:.0f}/s)')  # noqa: T201
+    print(f'received:     {stats.received} ({stats.received / elapsed:.0f}/s)')  # noqa: T201
+    print(f'server drops: {stats.missed}')  # noqa: T201
+    print(f'reconnects:   {stats.reconnects}')  # noqa: T201
+
+    if len(stats.latencies) > 1:
+        quantiles = statistics.quantiles(stats.latencies, n=1000, method='inclusive')
+        for name, index in (('p50', 499), ('p90', 899), ('p99', 989), ('p99.9', 998)):
+            print(f'latency {name:>5}: {quantiles[index] * 1000:9.2f} ms')  # noqa: T201
+        print(f'latency   max: {max(stats.latencies) * 1000:9.2f} ms')  # noqa: T201
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Websocket fan-out load generator')
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--topology', choices=('huge', 'small'), default='huge')
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=100, help='messages per second over all sessions')
+    parser.add_argument('--duration', type=float, default=30, help='seconds each session sends for')
+    parser.add_argument('--payload-size', type=int, default=64)
+    parser.add_argument('--compress', action='store_true', help='negotiate the deflate envelope subprotocol')
+    parser.add_argument('--ramp', type=float, default=200, help='new sessions per second per process')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--create-users', action='store_true', help='create the bench users through /v1/users')
+    parser.add_argument('--serve-stub', action='store_true', help='run a server that keeps everything in memory')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+
+    server = None
+    if args.serve_stub:
+        # inherited by the server process, which reads its settings when it imports the app
+        os.environ.update(stub.ENVIRONMENT)
+        server = context.Process(target=stub.serve, args=(settings.APP_HOST, settings.APP_PORT, args.password))
+        server.start()
+        time.sleep(3)
+
+    try:
+        if args.create_users:
+            asyncio.run(create_users(args))
+
+        chunks = [range(start, args.sessions, args.processes) for start in range(args.processes)]
+        with context.Pool(args.processes) as pool:
+            results = pool.starmap(worker, [(chunk, args) for chunk in chunks])
+
+        stats = Stats()
+        for result in results:
+            stats.merge(result)
+
+        report(stats, args)
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import logging
+import socket
+import sys
+
+import aiohttp
+import uvicorn
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import DBAPIConnection
+from sqlalchemy.pool import ConnectionPoolEntry, PoolProxiedConnection
+from starlette.status import HTTP_200_OK
+
+from tdb.poc_websockets.client.client import Client
+from tdb.poc_websockets.client.config import settings
+from tdb.poc_websockets.server import app, database
+
+logger = logging.getLogger(__name__)
+
+
+# Opens thousands of websockets against an in-process server and reports how many
+# pool connections they hold once the handshakes are done, which should be zero.
+#   python -m tdb.poc_websockets.bench.pool_checkouts --sockets 2000
+# Needs a local postgres with the client USER/PASS, and `ulimit -n` above twice the socket count.
+
+
+class PoolCounter:
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.checkins = 0
+
+        pool = database.engine.sync_engine.pool
+        event.listen(pool, 'checkout', self.on_checkout)
+        event.listen(pool, 'checkin', self.on_checkin)
+
+    def on_checkout(
+        self,
+        _dbapi_connection: DBAPIConnection,
+        _record: ConnectionPoolEntry,
+        _proxy: PoolProxiedConnection,
+    ) -> None:
+        self.checkouts += 1
+
+    def on_checkin(self, _dbapi_connection: DBAPIConnection | None, _record: ConnectionPoolEntry) -> None:
+        self.checkins += 1
+
+    @property
+    def held(self) -> int:
+        return self.checkouts - self.checkins
+
+
+class StartedServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config) -> None:
+        super().__init__(config)
+        self.ready = asyncio.Event()
+
+    async def startup(self, sockets: list[socket.socket] | None = None) -> None:
+        await super().startup(sockets)
+        self.ready.set()
+
+
+async def open_sockets(client: Client, sockets: int) -> int:
+    counter = PoolCounter()
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        login_data = {'grant_type': 'password', 'username': client.user, 'password': client.password}
+
+        async with session.post(client.login_uri, data=login_data) as response:
+            if response.status != HTTP_200_OK:
+                msg = f'Login failed: {response.status}'
+                raise RuntimeError(msg)
+
+        handshake_checkouts = counter.checkouts
+        websockets = await asyncio.gather(*(session.ws_connect(client.ws_uri) for _ in range(sockets)))
+        handshake_checkouts = counter.checkouts - handshake_checkouts
+
+        # let every handshake finish its lookup and return its connection
+        await asyncio.sleep(1)
+
+        print(f'open websockets:         {sum(not websocket.closed for websocket in websockets)}')  # noqa: T201
+        print(f'handshake checkouts:     {handshake_checkouts}')  # noqa: T201
+        print(f'held pool connections:   {counter.held}')  # noqa: T201
+        print(f'pool checked out now:    {database.pool_connections()[("checked_out",)]:.0f}')  # noqa: T201
+
+        await asyncio.gather(*(websocket.close() for websocket in websockets))
+
+    return handshake_checkouts
+
+
+async def main(sockets: int) -> int:
+    config = uvicorn.Config(app.app, host=settings.APP_HOST, port=settings.APP_PORT, log_level='warning')
+    server = StartedServer(config)
+    serve = asyncio.create_task(server.serve())
+
+    # a server that fails to start returns from serve without ever being ready
+    ready = asyncio.create_task(server.ready.wait())
+    await asyncio.wait({serve, ready}, return_when=asyncio.FIRST_COMPLETED)
+    if not server.ready.is_set():
+        ready.cancel()
+        msg = 'Server did not start'
+        raise RuntimeError(msg)
+
+    try:
+        return await open_sockets(Client(), sockets)
+    finally:
+        server.should_exit = True
+        await serve
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pool checkouts held by open websockets')
+    parser.add_argument('--sockets', type=int, default=2000)
+    args = parser.parse_args()
+
+    # the handshake must not hold a pool connection, a non-zero exit fails the check
+    if asyncio.run(main(args.sockets)):
+        sys.exit(1)
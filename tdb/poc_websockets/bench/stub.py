@@ -0,0 +1,63 @@
+from typing import Annotated, override
+
+import bcrypt
+import uvicorn
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tdb.poc_websockets.server import app, database
+from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.models.user import User, UserRepository
+from tdb.poc_websockets.server.routes import auth as auth_routes
+
+# In-process server that never touches postgres, so the load harness measures fan-out only. Every email is a valid
+# user with the given password. History and the deny-list are kept in memory through ENVIRONMENT, which has to be in
+# os.environ before the server process imports the app.
+
+ENVIRONMENT = {
+    'HISTORY_PERSIST': 'false',
+    'DENY_LIST_SYNC_SECONDS': '0',
+    # every session logs in and sends from the harness's one address
+    'RATE_LIMIT_LOGIN_RATE': '0',
+    'RATE_LIMIT_IP_RATE': '0',
+    # the huge topology sends far more into its one room than a room is allowed
+    'RATE_LIMIT_ROOM_RATE': '0',
+}
+
+
+class StubUserRepository(UserRepository):
+    def __init__(self, *, session: AsyncSession, users: dict[str, User], hashed: str) -> None:
+        super().__init__(session=session)
+        self.users = users
+        self.hashed = hashed
+
+    @override
+    async def get_by_email(self, email: str) -> User:
+        user = self.users.get(email)
+        if user is None:
+            user = self.users[email] = User(email=email, name=email, password=self.hashed)
+
+        return user
+
+
+def install(password: str) -> None:
+    # cheapest bcrypt cost, logins are not what is being measured
+    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+    users: dict[str, User] = {}
+
+    # sessions are opened lazily, the stub repository never uses its own
+    async def get_user_repository(db: Annotated[AsyncSession, Depends(database.get_session)]) -> UserRepository:
+        return StubUserRepository(session=db, users=users, hashed=hashed)
+
+    app.app.dependency_overrides[auth_routes.get_user_repository] = get_user_repository
+
+
+def serve(host: str, port: int, password: str) -> None:
+    install(password)
+    uvicorn.run(
+        app.app,
+        host=host,
+        port=port,
+        log_level='warning',
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE,
+    )
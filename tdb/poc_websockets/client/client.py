@@ -1,67 +1,194 @@
 import asyncio
+import json
 import logging
+import secrets
+import struct
+import zlib
 from asyncio import Queue
 
 import aiohttp
 from aiohttp import ClientWebSocketResponse, WSMessage
 from fastapi import APIRouter
-from starlette.status import HTTP_200_OK
+from starlette.status import HTTP_200_OK, HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
 from yarl import URL
 
 from tdb.poc_websockets.client.config import settings
+from tdb.poc_websockets.server import protocol
+from tdb.poc_websockets.server.protocol import SUBPROTOCOL, SUBPROTOCOL_DEFLATE, Envelope, Kind
 from tdb.poc_websockets.server.routes.auth import login_token
 from tdb.poc_websockets.server.routes.auth import router as auth_router
 from tdb.poc_websockets.server.routes.websocket import router as websocket_router
 from tdb.poc_websockets.server.routes.websocket import ws_room
+from tdb.poc_websockets.server.shards import shard_for, shard_port
 
 logger = logging.getLogger(__name__)
 
+# login refusals that pass, retried with the backoff, any other one is final
+RETRY_LOGIN = frozenset({HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE})
+
+
+class LoginError(Exception):
+    pass
+
 
 class Client:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        *,
+        user: str = settings.USER,
+        password: str = settings.PASS,
+        room: str = settings.ROOM,
+        binary: bool = settings.BINARY,
+        compress: bool = settings.COMPRESS,
+    ) -> None:
         logger.debug('Initializing Client')
 
+        self.user = user
+        self.password = password
+        self.room = room
+        self.binary = binary
+        self.compress = compress
+
         self.base_url = URL.build(host=settings.APP_HOST, port=settings.APP_PORT)
         self.app_url = self.base_url.with_scheme(settings.APP_SCHEMA)
 
         self.login_uri = self.build_uri(settings.APP_SCHEMA, auth_router, login_token.__name__)
-        self.ws_uri = self.build_uri('ws', websocket_router, ws_room.__name__, room='testRoom')
+        self.ws_uri = self.build_uri('ws', websocket_router, ws_room.__name__, room=room)
+        if settings.WS_SHARDS > 1:
+            # a sharded server only accepts a room's websockets on the room's own shard
+            self.ws_uri = str(URL(self.ws_uri).with_port(shard_port(shard_for(room))))
 
-        self.consumer_queue: Queue[str | None] = Queue(-1)
+        self.consumer_queue: Queue[str | Envelope | None] = Queue(-1)
         self.producer_queue: Queue[str | None] = Queue(-1)
 
+        self.random = secrets.SystemRandom()
+        self.finished = False
+        self.attempts = 0
+        # delay asked for by a draining server, used instead of the backoff for the next reconnect
+        self.reconnect_delay: float | None = None
+
+        # control envelopes answered by the client itself, every other kind is handed to receive
+        self.controls = {Kind.PING: self.on_ping, Kind.RECONNECT: self.on_reconnect}
+
+        # where to resume from after a reconnect, binary envelopes only
+        self.epoch: str | None = None
+        self.last_seq = 0
+        self.missed = 0
+
     def build_uri(self, schema: str, router: APIRouter, function_name: str, **path_params: str) -> str:
         with_scheme = self.base_url.with_scheme(schema)
         uri_path = router.url_path_for(function_name, **path_params)
         return str(with_scheme.joinpath(uri_path[1:]))
 
+    def resume_uri(self) -> str:
+        if self.epoch is None:
+            return self.ws_uri
+
+        return str(URL(self.ws_uri).with_query(resume_from=self.last_seq, epoch=self.epoch))
+
+    def backoff(self) -> float:
+        # full jitter, so clients dropped together do not all come back together
+        ceiling = settings.RECONNECT_BACKOFF_MIN * 2**self.attempts
+        return self.random.uniform(0, min(settings.RECONNECT_BACKOFF_MAX, ceiling))
+
+    def track(self, envelope: Envelope) -> None:
+        match envelope.kind:
+            case Kind.SYNC:
+                self.epoch = envelope.payload.decode('ascii')
+                self.last_seq = envelope.seq
+
+            case Kind.RESYNC:
+                logger.warning('Missed messages are outside the replay window, full resync')
+                self.last_seq = 0
+
+            # the server acknowledges this client's own messages instead of echoing them
+            case Kind.MESSAGE | Kind.ACK if envelope.seq:
+                if self.last_seq and envelope.seq > self.last_seq + 1:
+                    self.missed += envelope.seq - self.last_seq - 1
+                    logger.warning('Server dropped messages %d to %d', self.last_seq + 1, envelope.seq - 1)
+
+                self.last_seq = max(self.last_seq, envelope.seq)
+
+    def pack(self, websocket: ClientWebSocketResponse, envelope: Envelope) -> bytes:
+        data = protocol.encode(envelope)
+
+        if websocket.protocol == SUBPROTOCOL_DEFLATE:
+            level = settings.WS_COMPRESSION_LEVEL
+            return protocol.deflate(data, min_size=settings.WS_COMPRESSION_MIN_SIZE, level=level)
+
+        return data
+
+    def unpack(self, websocket: ClientWebSocketResponse, data: bytes) -> Envelope:
+        if websocket.protocol == SUBPROTOCOL_DEFLATE:
+            data = protocol.inflate(data)
+
+        return protocol.decode(data)
+
     async def consumer(self, websocket: ClientWebSocketResponse) -> None:
         logger.debug('Starting consumer')
 
+        handlers = {aiohttp.WSMsgType.TEXT: self.on_text, aiohttp.WSMsgType.BINARY: self.on_binary}
+
         message: WSMessage
         while True:
             async for message in websocket:
-                if message.type == aiohttp.WSMsgType.TEXT:
-                    data = message.data
-                    logger.debug('consumer message: %s', data)
-                    await self.consumer_queue.put(data)
-                elif message.type == aiohttp.WSMsgType.ERROR:
-                    logger.error('Websocket Error')
-                    if not websocket.closed:
-                        await websocket.close()
-                        break
+                handler = handlers.get(message.type)
+                if handler is not None:
+                    await handler(websocket, message)
+                    continue
 
+                if message.type == aiohttp.WSMsgType.ERROR:
+                    logger.error('Websocket Error')
                 else:
                     logger.error('Unexpected message type')
-                    if not websocket.closed:
-                        await websocket.close()
-                        break
+
+                if not websocket.closed:
+                    await websocket.close()
+                    break
 
             if websocket.closed:
                 break
 
         logger.debug('Exited consumer')
 
+    async def on_text(self, _websocket: ClientWebSocketResponse, message: WSMessage) -> None:
+        data = message.data
+        logger.debug('consumer message: %s', data)
+
+        # batched rooms send a json array of messages
+        for text in json.loads(data) if data.startswith('[') else [data]:
+            await self.receive(text)
+
+    async def on_binary(self, websocket: ClientWebSocketResponse, message: WSMessage) -> None:
+        try:
+            envelope = self.unpack(websocket, message.data)
+            envelopes = envelope.unbatch() if envelope.kind is Kind.BATCH else [envelope]
+        except (struct.error, zlib.error, ValueError):
+            logger.warning('Dropping malformed frame')
+            return
+
+        logger.debug('consumer envelope: %s', envelope)
+
+        control = self.controls.get(envelope.kind)
+        if control is not None:
+            await control(websocket, envelope)
+            return
+
+        for inner in envelopes:
+            self.track(inner)
+            if inner.kind is not Kind.ACK:
+                await self.receive(inner)
+
+    async def on_ping(self, websocket: ClientWebSocketResponse, _envelope: Envelope) -> None:
+        await websocket.send_bytes(self.pack(websocket, Envelope.control(Kind.PONG, room=self.room)))
+
+    async def on_reconnect(self, _websocket: ClientWebSocketResponse, envelope: Envelope) -> None:
+        self.reconnect_delay = float(envelope.payload.decode('ascii'))
+        logger.info('Server is draining, reconnecting in %.2f seconds', self.reconnect_delay)
+
+    async def receive(self, message: str | Envelope) -> None:
+        await self.consumer_queue.put(message)
+
     async def producer(self, websocket: ClientWebSocketResponse) -> None:
         logger.debug('Starting producer')
 
@@ -70,22 +197,25 @@ class Client:
 
             if message is None:
                 logger.debug('Message queue is empty, closing loop')
+                self.finished = True
+                await websocket.close()
                 break
 
             logger.debug('Sending message: %s', message)
-            await websocket.send_str(message)
+            if websocket.protocol in {SUBPROTOCOL, SUBPROTOCOL_DEFLATE}:
+                # room and sender are set by the server from the connection
+                envelope = Envelope.message(message.encode('utf-8'), room='', sender='')
+                await websocket.send_bytes(self.pack(websocket, envelope))
+            else:
+                await websocket.send_str(message)
 
         logger.debug('Exited producer')
 
     async def generate_message(self) -> None:
         logger.debug('Starting generator')
 
-        import secrets
-
-        random = secrets.SystemRandom()
-
         for r in range(10):
-            random_number = random.randrange(5, 10 + 1)
+            random_number = self.random.randrange(5, 10 + 1)
 
             logger.debug('Sleeping for %d seconds [%d]', random_number, r)
             await self.producer_queue.put(f'Rand: {random_number}')
@@ -95,28 +225,89 @@ class Client:
 
         logger.debug('Exited generator')
 
-    async def run(self) -> None:
+    async def login(self, session: aiohttp.ClientSession) -> bool:
         logger.debug('Login to Client: %s', self.login_uri)
 
+        login_data = {'grant_type': 'password', 'username': self.user, 'password': self.password}
+
+        async with session.post(self.login_uri, data=login_data) as response:
+            if response.status == HTTP_200_OK:
+                return True
+
+            if response.status in RETRY_LOGIN:
+                logger.warning('Login refused for now: %d', response.status)
+                return False
+
+            msg = f'Login refused: {response.status}'
+            raise LoginError(msg)
+
+    async def connect(self, session: aiohttp.ClientSession) -> None:
+        logger.debug('Connecting to websocket')
+
+        protocols: tuple[str, ...] = ()
+        if self.binary:
+            protocols = (SUBPROTOCOL_DEFLATE, SUBPROTOCOL) if self.compress else (SUBPROTOCOL,)
+
+        # deflated envelopes are already compressed, permessage-deflate would only burn cpu on both ends
+        per_message_deflate = 15 if self.compress and not self.binary else 0
+
+        uri = self.resume_uri()
+        async with session.ws_connect(uri, protocols=protocols, compress=per_message_deflate) as websocket:
+            self.attempts = 0
+            logger.debug('Starting consumer / producer tasks')
+
+            consumer = asyncio.create_task(self.consumer(websocket))
+            producer = asyncio.create_task(self.producer(websocket))
+
+            # the server went away, or there is nothing left to send
+            done, pending = await asyncio.wait((consumer, producer), return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                task.result()
+
+            logger.debug('Exited consumer / producer tasks')
+
+        logger.debug('Exited websocket')
+
+    async def run(self) -> None:
+        generator = asyncio.create_task(self.generate_message())
+
         async with aiohttp.ClientSession() as session:
-            login_data = {'grant_type': 'password', 'username': settings.USER, 'password': settings.PASS}
+            logged_in = False
+
+            while not self.finished:
+                try:
+                    logged_in = logged_in or await self.login(session)
+                    if logged_in:
+                        await self.connect(session)
 
-            async with session.post(self.login_uri, data=login_data) as response:
-                if response.status == HTTP_200_OK:
-                    logger.debug('Connecting to websocket')
+                except LoginError:
+                    # wrong credentials or a disabled user, no retry can get past them
+                    logger.exception('Giving up')
+                    generator.cancel()
+                    break
 
-                    async with session.ws_connect(self.ws_uri) as websocket:
-                        logger.debug('Starting consumer / producer tasks')
+                except aiohttp.WSServerHandshakeError as error:
+                    logger.warning('Websocket handshake failed: %d', error.status)
+                    # expired or revoked token, log in again before the next attempt
+                    logged_in = False
 
-                        async with asyncio.TaskGroup() as task_group:
-                            task_group.create_task(self.consumer(websocket))
-                            task_group.create_task(self.producer(websocket))
-                            task_group.create_task(self.generate_message())
+                except (aiohttp.ClientError, OSError):
+                    logger.exception('Websocket connection failed')
 
-                        logger.debug('Exited consumer / producer tasks')
+                if not self.finished:
+                    delay = self.backoff() if self.reconnect_delay is None else self.reconnect_delay
+                    self.reconnect_delay = None
+                    self.attempts += 1
 
-                    logger.debug('Exited websocket')
+                    logger.debug('Reconnecting in %.2f seconds', delay)
+                    await asyncio.sleep(delay)
 
             logger.debug('Exited session')
 
+        await asyncio.gather(generator, return_exceptions=True)
+
         logger.debug('Exited client')
@@ -5,6 +5,13 @@ class ClientConfig(ApplicationConfig):
     USER: str
     PASS: str
     ROOM: str
+    # speak the binary envelope subprotocol instead of plain text
+    BINARY: bool = False
+    # permessage-deflate for text, the deflate envelope subprotocol for binary
+    COMPRESS: bool = True
+    # jittered exponential backoff between reconnects, in seconds
+    RECONNECT_BACKOFF_MIN: float = 0.5
+    RECONNECT_BACKOFF_MAX: float = 30
 
     def __init__(self) -> None:
         super().__init__(setup_logging=False)
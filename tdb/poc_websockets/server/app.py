@@ -6,10 +6,14 @@ import fastapi
 from starlette import staticfiles
 from starlette.middleware.cors import CORSMiddleware
 
-from tdb.poc_websockets.server import config
-from tdb.poc_websockets.server.logger import force_logging
+from tdb.poc_websockets.server import auth as server_auth
+from tdb.poc_websockets.server import config, health
+from tdb.poc_websockets.server.logger import force_logging, stop_logging
+from tdb.poc_websockets.server.ratelimit import limits
+from tdb.poc_websockets.server.revocation import deny_list
 from tdb.poc_websockets.server.routes import auth, room, status, websocket
-from tdb.poc_websockets.server.routes.v1 import user
+from tdb.poc_websockets.server.routes.v1 import batching, presence, shards, user
+from tdb.poc_websockets.server.websocket import manager
 
 
 @asynccontextmanager
@@ -19,9 +23,22 @@ async def lifespan(_fast_api: fastapi.FastAPI) -> AsyncGenerator[None, None]:
     logger = logging.getLogger(__name__)
     # on_startup
     logger.debug('Application Startup')
+    await deny_list.start()
+    await manager.start()
+    health.loop_lag.start()
+    limits.start()
     yield None
     # on_shutdown
     logger.debug('Application Shutdown')
+    # already done when the server drained before shutting down, see server.drain
+    await manager.start_drain()
+    await health.loop_lag.stop()
+    await limits.stop()
+    await manager.stop()
+    await deny_list.stop()
+    server_auth.password_pool.shutdown()
+    # write out everything still queued, later records go straight to stdout
+    stop_logging()
 
 
 settings = config.settings
@@ -51,6 +68,9 @@ app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(websocket.router)
 app.include_router(room.router)
+app.include_router(presence.router)
+app.include_router(batching.router)
+app.include_router(shards.router)
 
 app.mount(
     '/static',
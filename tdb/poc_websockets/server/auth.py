@@ -1,4 +1,6 @@
 import logging
+import secrets
+import time
 from datetime import UTC, datetime, timedelta
 from typing import Annotated
 
@@ -10,14 +12,18 @@ from fastapi.openapi.models import OAuthFlows as OAuthFlowsModel
 from fastapi.security import OAuth2
 from fastapi.security.utils import get_authorization_scheme_param
 from jwt.exceptions import InvalidTokenError
-from pydantic import EmailStr
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED
 
-from tdb.poc_websockets.server import database
+from tdb.poc_websockets.server import database, metrics
+from tdb.poc_websockets.server.cache import token_cache, user_cache
 from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.models.auth_token import TokenUser
 from tdb.poc_websockets.server.models.user import User, UserRepository
+from tdb.poc_websockets.server.revocation import deny_list
+from tdb.poc_websockets.server.workers import BoundedExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -41,7 +47,6 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
     async def __call__(self, request: Request) -> str | None:
         # changed to accept access token from httpOnly Cookie
         authorization = request.cookies.get('access_token')
-        logger.debug('access_token is %s', authorization)
 
         scheme, param = get_authorization_scheme_param(authorization)
         if not authorization or scheme.lower() != 'bearer':
@@ -57,50 +62,167 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
 
 
 oauth2_bearer = OAuth2PasswordBearerWithCookie(token_url='/auth/login')
+optional_bearer = OAuth2PasswordBearerWithCookie(token_url='/auth/login', auto_error=False)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        bytes(plain_password, encoding='utf-8'),
-        bytes(hashed_password, encoding='utf-8'),
-    )
+# bcrypt releases the GIL, so threads keep the event loop free while hashing
+password_pool = BoundedExecutor(
+    'password-hash',
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    max_pending=settings.PASSWORD_HASH_MAX_PENDING,
+)
 
 
-def get_password_hash(password: str) -> str:
-    return bcrypt.hashpw(
-        bytes(password, encoding='utf-8'),
-        bcrypt.gensalt(),
-    ).decode('utf-8')
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    with metrics.password_hash_seconds.time():
+        return await password_pool.run(
+            bcrypt.checkpw,
+            bytes(plain_password, encoding='utf-8'),
+            bytes(hashed_password, encoding='utf-8'),
+        )
 
 
-def create_access_token(data: dict[str, EmailStr], expires_delta: timedelta | None = None) -> str:
-    to_encode: dict[str, EmailStr | datetime] = dict(data)
-    now = datetime.now(UTC)
-    expire = now + expires_delta if expires_delta else now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({'exp': expire})
+async def get_password_hash(password: str) -> str:
+    with metrics.password_hash_seconds.time():
+        hashed = await password_pool.run(
+            bcrypt.hashpw,
+            bytes(password, encoding='utf-8'),
+            bcrypt.gensalt(),
+        )
+    return hashed.decode('utf-8')
 
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
+def create_access_token(user: User, expires_delta: timedelta | None = None) -> str:
+    now = datetime.now(UTC)
+    expire = now + expires_delta if expires_delta else now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
 
-async def get_current_user(
-    token: Annotated[str, Depends(oauth2_bearer)],
-    db: Annotated[AsyncSession, Depends(database.get_session)],
-) -> User:
-    credentials_exception = HTTPException(
+    # everything a request is authorized on travels in the token, so a valid one needs no database lookup
+    claims = {
+        'sub': user.email,
+        'uid': str(user.id),
+        'disabled': user.disabled,
+        'jti': secrets.token_urlsafe(16),
+        'iat': now.timestamp(),
+        'exp': expire,
+    }
+    headers = {'kid': settings.SECRET_KEY_ID}
+    return jwt.encode(claims, settings.SECRET_KEY, algorithm=settings.ALGORITHM, headers=headers)
+
+
+def credentials_error() -> HTTPException:
+    return HTTPException(
         status_code=HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
         headers={'WWW-Authenticate': 'Bearer'},
     )
+
+
+def verification_key(token: str) -> str:
+    # tokens from before key ids were issued have none and were signed with the current key
+    kid = jwt.get_unverified_header(token).get('kid')
+    if kid is None or kid == settings.SECRET_KEY_ID:
+        return settings.SECRET_KEY
+
+    key = settings.PREVIOUS_SECRET_KEYS.get(kid)
+    if key is None:
+        msg = f'Unknown signing key {kid}'
+        raise InvalidTokenError(msg)
+
+    return key
+
+
+async def decode_token(token: str, db: AsyncSession) -> TokenUser:
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email = payload.get('sub')
-        if email is None:
-            raise credentials_exception
+        with metrics.jwt_decode_seconds.time():
+            payload = jwt.decode(
+                token,
+                verification_key(token),
+                algorithms=[settings.ALGORITHM],
+                options={'require': ['exp', 'sub']},
+            )
 
     except InvalidTokenError:
-        raise credentials_exception from None
+        raise credentials_error() from None
+
+    if 'uid' in payload:
+        return TokenUser(
+            id=payload['uid'],
+            email=payload['sub'],
+            disabled=payload.get('disabled', False),
+            jti=payload.get('jti'),
+            issued_at=payload.get('iat', 0),
+            expires_at=payload['exp'],
+        )
+
+    # issued before the claims were added, looked up once, then cached like any other token until it expires
+    user = user_cache.get_by_email(payload['sub'])
+    if user is None:
+        try:
+            user = await UserRepository(session=db).get_by_email(payload['sub'])
+        except NoResultFound:
+            raise credentials_error() from None
+
+        user_cache.add(user)
+
+    return TokenUser(
+        id=user.id,
+        email=user.email,
+        disabled=user.disabled,
+        jti=None,
+        issued_at=payload.get('iat', 0),
+        expires_at=payload['exp'],
+    )
+
+
+async def get_current_claims(
+    token: Annotated[str, Depends(oauth2_bearer)],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> TokenUser:
+    # the session is lazy, a verified token never checks out a connection
+    token_user = token_cache.get(token)
+    if token_user is None:
+        metrics.token_cache_lookups.inc(1, 'miss')
+        token_user = await decode_token(token, db)
+        token_cache.set(token, token_user, ttl=token_user.expires_at - time.time())
+    else:
+        metrics.token_cache_lookups.inc(1, 'hit')
+
+    # revocations are not part of the cached entry, they can arrive at any time
+    if deny_list.denied(token_user):
+        metrics.tokens_denied.inc()
+        raise credentials_error()
+
+    return token_user
+
+
+async def get_current_user(
+    token_user: Annotated[TokenUser, Depends(get_current_claims)],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> User:
+    # only for routes needing the stored user, the claims are enough to authorize
+    user = user_cache.get(token_user.id)
+    if user is None:
+        try:
+            user = await UserRepository(session=db).read(token_user.id)
+        except NoResultFound:
+            raise credentials_error() from None
+
+        user_cache.add(user)
+
+    return user
 
-    return await UserRepository(session=db).get_by_email(email)
+
+async def get_websocket_user(token: str) -> TokenUser:
+    # websockets outlive any request scoped session, one is only connected for tokens issued without claims
+    async with database.SessionLocal() as db:
+        return await get_current_claims(token, db)
+
+
+async def get_current_active_claims(token_user: Annotated[TokenUser, Depends(get_current_claims)]) -> TokenUser:
+    if token_user.disabled:
+        raise HTTPException(status_code=400, detail='Inactive user')
+
+    return token_user
 
 
 async def get_current_active_user(current_user: Annotated[User, Depends(get_current_user)]) -> User:
@@ -108,3 +230,14 @@ async def get_current_active_user(current_user: Annotated[User, Depends(get_curr
         raise HTTPException(status_code=400, detail='Inactive user')
 
     return current_user
+
+
+async def revoke_token(token: str, db: AsyncSession) -> None:
+    # an invalid or already revoked token has nothing left to revoke
+    try:
+        token_user = await get_current_claims(token, db)
+    except HTTPException:
+        return
+
+    token_cache.pop(token)
+    await deny_list.revoke_token(db, token_user)
@@ -0,0 +1,224 @@
+import asyncio
+import base64
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+
+import asyncpg  # type: ignore[import-untyped]
+
+from tdb.poc_websockets.server import protocol
+from tdb.poc_websockets.server.config import BrokerBackend, settings
+from tdb.poc_websockets.server.protocol import Envelope
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Envelope], None]
+
+# Postgres NOTIFY payloads must be shorter than 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7999
+
+
+# Fans room messages out to the other processes serving the same rooms
+class Broker(ABC):
+    def __init__(self) -> None:
+        self.handler: Handler | None = None
+
+    def set_handler(self, handler: Handler) -> None:
+        self.handler = handler
+
+    @property
+    def healthy(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def start(self) -> None: ...
+
+    @abstractmethod
+    async def stop(self) -> None: ...
+
+    @abstractmethod
+    async def subscribe(self, room: str) -> None: ...
+
+    @abstractmethod
+    async def unsubscribe(self, room: str) -> None: ...
+
+    @abstractmethod
+    async def publish(self, message: Envelope, /) -> None: ...
+
+
+class InMemoryBroker(Broker):
+    # Single process, every room member is local so there is nobody else to tell
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def subscribe(self, room: str) -> None:
+        pass
+
+    async def unsubscribe(self, room: str) -> None:
+        pass
+
+    async def publish(self, message: Envelope, /) -> None:
+        pass
+
+
+class PostgresBroker(Broker):
+    def __init__(self, dsn: str, *, reconnect_delay: float = 1.0) -> None:
+        super().__init__()
+
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+
+        # identifies notifications sent by this process, local members are delivered to directly
+        self.origin = uuid.uuid4().hex
+        # postgres collapses identical notifications within a transaction
+        self._nonce = itertools.count()
+
+        self._channels: dict[str, str] = {}
+        self._listener: asyncpg.Connection | None = None
+        self._listener_lock = asyncio.Lock()
+
+        self._outbound: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+        self._publisher: asyncpg.Connection | None = None
+        self._publisher_task: asyncio.Task[None] | None = None
+        self._reconnect_task: asyncio.Task[None] | None = None
+        self._stopping = False
+
+    @staticmethod
+    def channel(room: str) -> str:
+        # room names are arbitrary text, channels are identifiers limited to 63 bytes
+        return f'room_{hashlib.blake2b(room.encode("utf-8"), digest_size=16).hexdigest()}'
+
+    @property
+    def healthy(self) -> bool:
+        return self._listener is not None and not self._listener.is_closed()
+
+    async def start(self) -> None:
+        self._stopping = False
+        await self._connect_listener()
+        self._publisher_task = asyncio.create_task(self._publish_loop(), name='broker-publisher')
+
+    async def stop(self) -> None:
+        self._stopping = True
+
+        for task in (self._publisher_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+        for connection in (self._listener, self._publisher):
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+
+        self._listener = None
+        self._publisher = None
+
+    async def subscribe(self, room: str) -> None:
+        async with self._listener_lock:
+            if room in self._channels:
+                return
+
+            channel = self.channel(room)
+            self._channels[room] = channel
+
+            if self._listener is not None:
+                await self._listener.add_listener(channel, self._on_notify)
+
+            logger.debug('Subscribed to room %s (%s)', room, channel)
+
+    async def unsubscribe(self, room: str) -> None:
+        async with self._listener_lock:
+            channel = self._channels.pop(room, None)
+
+            if channel is not None and self._listener is not None:
+                await self._listener.remove_listener(channel, self._on_notify)
+
+            logger.debug('Unsubscribed from room %s (%s)', room, channel)
+
+    async def publish(self, message: Envelope, /) -> None:
+        envelope = base64.b64encode(protocol.encode(message)).decode('ascii')
+        payload = json.dumps({'o': self.origin, 'n': next(self._nonce), 'e': envelope}, separators=(',', ':'))
+
+        if len(payload) > MAX_NOTIFY_PAYLOAD:
+            logger.error('Message too large for broker, room %s only received it locally', message.room)
+            return
+
+        self._outbound.put_nowait((self.channel(message.room), payload))
+
+    async def _publish_loop(self) -> None:
+        while True:
+            # send everything that queued up while the previous batch was in flight in one round trip
+            batch = [await self._outbound.get()]
+            while not self._outbound.empty():
+                batch.append(self._outbound.get_nowait())
+
+            channels, payloads = zip(*batch, strict=True)
+
+            try:
+                if self._publisher is None or self._publisher.is_closed():
+                    self._publisher = await asyncpg.connect(self.dsn)
+
+                await self._publisher.execute(
+                    'SELECT pg_notify(c, p) FROM unnest($1::text[], $2::text[]) AS t(c, p)',
+                    list(channels),
+                    list(payloads),
+                )
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logger.exception('Failed to publish %d messages', len(batch))
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _connect_listener(self) -> None:
+        async with self._listener_lock:
+            self._listener = await asyncpg.connect(self.dsn)
+            self._listener.add_termination_listener(self._on_terminate)
+
+            for channel in self._channels.values():
+                await self._listener.add_listener(channel, self._on_notify)
+
+    async def _reconnect(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(self.reconnect_delay)
+
+            try:
+                await self._connect_listener()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logger.exception('Broker listener reconnect failed')
+            else:
+                logger.info('Broker listener reconnected')
+                return
+
+    def _on_terminate(self, _connection: asyncpg.Connection) -> None:
+        if self._stopping:
+            return
+
+        logger.error('Broker listener connection lost, reconnecting')
+        self._listener = None
+        self._reconnect_task = asyncio.create_task(self._reconnect(), name='broker-reconnect')
+
+    def _on_notify(self, _connection: asyncpg.Connection, _pid: int, _channel: str, payload: str) -> None:
+        data = json.loads(payload)
+
+        if data['o'] == self.origin or self.handler is None:
+            return
+
+        self.handler(protocol.decode(base64.b64decode(data['e'])))
+
+
+def create_broker() -> Broker:
+    match settings.BROKER_BACKEND:
+        case BrokerBackend.POSTGRES:
+            # asyncpg expects a plain postgres dsn, without the sqlalchemy driver suffix
+            dsn = str(settings.ASYNC_POSTGRES_URI).replace('postgresql+asyncpg://', 'postgresql://', 1)
+            return PostgresBroker(dsn)
+
+        case BrokerBackend.MEMORY:
+            return InMemoryBroker()
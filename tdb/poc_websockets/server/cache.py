@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Generic, TypeVar
+from uuid import UUID
+
+from tdb.poc_websockets.server.config import settings
+
+if TYPE_CHECKING:
+    from tdb.poc_websockets.server.models.auth_token import TokenUser
+    from tdb.poc_websockets.server.models.user import User
+
+Key = TypeVar('Key')
+Value = TypeVar('Value')
+
+
+class TTLCache(Generic[Key, Value]):
+    def __init__(self, *, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # least recently used first, values are (expires, value)
+        self._data: OrderedDict[Key, tuple[float, Value]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Key) -> Value | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Key, value: Value, *, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Key) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class UserCache:
+    def __init__(self, *, maxsize: int, ttl: float) -> None:
+        # emails only point at ids, so invalidating an id drops every way of reaching the user
+        self.users: TTLCache[UUID, User] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.emails: TTLCache[str, UUID] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, ident: UUID) -> 'User | None':
+        return self.users.get(ident)
+
+    def get_by_email(self, email: str) -> 'User | None':
+        ident = self.emails.get(email)
+        return None if ident is None else self.users.get(ident)
+
+    def add(self, user: 'User') -> None:
+        self.users.set(user.id, user)
+        self.emails.set(user.email, user.id)
+
+    def invalidate(self, ident: UUID) -> None:
+        self.users.pop(ident)
+
+    def clear(self) -> None:
+        self.users.clear()
+        self.emails.clear()
+
+
+user_cache = UserCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS)
+
+# Verified claims by raw token, each kept until the token expires. Revocations are checked on every hit, see
+# revocation.DenyList.
+token_cache: 'TTLCache[str, TokenUser]' = TTLCache(
+    maxsize=settings.TOKEN_CACHE_SIZE,
+    ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+)
@@ -1,10 +1,33 @@
 import sys
+from enum import StrEnum
 from pathlib import Path
 
+from pydantic import Field
 from pydantic.networks import PostgresDsn
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+class SlowConsumerPolicy(StrEnum):
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    DISCONNECT = 'disconnect'
+
+
+class BrokerBackend(StrEnum):
+    MEMORY = 'memory'
+    POSTGRES = 'postgres'
+
+
+class RateLimitMode(StrEnum):
+    DROP = 'drop'
+    THROTTLE = 'throttle'
+
+
+class LogFormat(StrEnum):
+    TEXT = 'text'
+    JSON = 'json'
+
+
 class ApplicationConfig(BaseSettings):
     VERSION: str
     PROJECT_NAME: str
@@ -15,16 +38,134 @@ class ApplicationConfig(BaseSettings):
     POSTGRES_PORT: int
     POSTGRES_ECHO: bool
     POSTGRES_POOL_SIZE: int
+    # Connections past the pool size are opened under load and closed when returned, a checkout waits up to the timeout
+    # for one before failing. Pre-ping replaces connections the server or a proxy dropped while idle, recycling closes
+    # them before any idle timeout in between does.
+    POSTGRES_MAX_OVERFLOW: int = 10
+    POSTGRES_POOL_TIMEOUT_SECONDS: float = 5
+    POSTGRES_POOL_PRE_PING: bool = True
+    POSTGRES_POOL_RECYCLE_SECONDS: int = 1800
+    # prepared statements kept per connection, 0 behind pgbouncer in transaction mode
+    POSTGRES_STATEMENT_CACHE_SIZE: int = 500
+    # statements running longer are logged, 0 disables
+    POSTGRES_SLOW_QUERY_MS: float = 200
     ASYNC_POSTGRES_URI: PostgresDsn
+    # Read replicas, as a json list, any SQLAlchemy async url. Repository reads are spread over them round-robin, rows
+    # written through a worker are read back from the primary for the read-your-writes window after the write.
+    ASYNC_POSTGRES_REPLICA_URI: list[str] = Field(default_factory=list)
+    REPLICA_READ_YOUR_WRITES_SECONDS: float = 5
     ENV: str
     APP_HOST: str
     APP_PORT: int
     APP_SCHEMA: str
     LOG_LEVEL: str = 'DEBUG'
+    LOG_FORMAT: LogFormat = LogFormat.TEXT
+    # By logger name, children included: fraction of DEBUG / INFO records kept, and records per second below ERROR
+    LOG_SAMPLING: dict[str, float] = Field(default_factory=dict)
+    LOG_RATE_LIMITS: dict[str, float] = Field(
+        default_factory=lambda: {
+            'tdb.poc_websockets.client.client': 100.0,
+            'tdb.poc_websockets.server.routes.websocket': 100.0,
+            'tdb.poc_websockets.server.websocket': 100.0,
+        },
+    )
+    # records written to the file and stdout in one go
+    LOG_BATCH_SIZE: int = 512
+    LOG_FILE_MAX_BYTES: int = 10 * 1024 * 1024
+    LOG_FILE_BACKUP_COUNT: int = 5
 
     SECRET_KEY: str
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
+    # Tokens are signed with SECRET_KEY under SECRET_KEY_ID, and still verified with any key listed by id here. To
+    # rotate, list the new key here on every worker first, then swap it in as SECRET_KEY and keep the old one listed
+    # until the tokens it signed have expired.
+    SECRET_KEY_ID: str = 'primary'  # noqa: S105  # the key's id, sent in every token header, not a secret
+    PREVIOUS_SECRET_KEYS: dict[str, str] = Field(default_factory=dict)
+    # verified tokens, kept until they expire
+    TOKEN_CACHE_SIZE: int = 10_000
+    # revoked tokens and users are read back from postgres, so every worker denies them within this interval, 0 turns
+    # syncing off and a worker only denies its own revocations
+    DENY_LIST_SYNC_SECONDS: float = 5
+
+    # Outbound websocket queues
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SLOW_CONSUMER_POLICY: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST
+
+    # Liveness, binary clients are pinged and evicted once idle, 0 disables the idle timeout
+    WS_HEARTBEAT_INTERVAL_SECONDS: float = 15
+    WS_IDLE_TIMEOUT_SECONDS: float = 45
+    WS_TEXT_IDLE_TIMEOUT_SECONDS: float = 0
+    # protocol level pings sent by uvicorn, answered by every client including browsers
+    WS_PROTOCOL_PING_INTERVAL_SECONDS: float = 20
+    WS_PROTOCOL_PING_TIMEOUT_SECONDS: float = 20
+    TIMER_WHEEL_TICK_MS: int = 500
+    TIMER_WHEEL_SLOTS: int = 512
+
+    # Compression, permessage-deflate is negotiated by uvicorn and runs once per recipient, the deflate envelope
+    # subprotocol compresses a broadcast once for every recipient, frames under the minimum size are sent as is
+    WS_PER_MESSAGE_DEFLATE: bool = True
+    WS_ENVELOPE_DEFLATE: bool = True
+    WS_COMPRESSION_MIN_SIZE: int = 256
+    WS_COMPRESSION_LEVEL: int = 6
+
+    # Micro-batching, batched rooms send everything delivered within the window, up to the message limit, as one frame
+    WS_BATCH_ROOMS: frozenset[str] = frozenset()
+    WS_BATCH_WINDOW_MS: float = 10
+    WS_BATCH_MAX_MESSAGES: int = 64
+
+    # Graceful drain, clients are told to reconnect within the spread, whatever is still open at the deadline is dropped
+    DRAIN_TIMEOUT_SECONDS: float = 30
+    DRAIN_RECONNECT_SPREAD_SECONDS: float = 10
+
+    # Cross process room fan-out
+    BROKER_BACKEND: BrokerBackend = BrokerBackend.MEMORY
+
+    # Room sharding, rooms are hashed onto this many server processes, see shards, WS_SHARD is this process's index.
+    # Every shard serves the whole app on APP_PORT + WS_SHARD with its own database pool, so postgres sees up to
+    # WS_SHARDS * (POSTGRES_POOL_SIZE + POSTGRES_MAX_OVERFLOW) connections
+    WS_SHARDS: int = 1
+    WS_SHARD: int = 0
+
+    # Authenticated user lookups
+    USER_CACHE_SIZE: int = 10_000
+    USER_CACHE_TTL_SECONDS: float = 60
+
+    # bcrypt runs on its own threads, requests past the queue limit get a 503
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 64
+
+    # Room history, replayed on join and written behind in batches
+    HISTORY_SIZE: int = 50
+    HISTORY_FLUSH_INTERVAL_MS: int = 250
+    HISTORY_FLUSH_SIZE: int = 500
+    # messages kept for a retry while postgres is unavailable, the oldest are dropped past it
+    HISTORY_MAX_PENDING: int = 50_000
+    # off, a room only replays what this worker has seen and nothing is read from or written to postgres
+    HISTORY_PERSIST: bool = True
+
+    # Readiness / liveness, a worker past any of these limits reports 503
+    WS_MAX_CONNECTIONS: int = 20_000
+    READY_LOOP_LAG_INTERVAL_MS: int = 250
+    READY_MAX_LOOP_LAG_MS: int = 200
+    READY_MAX_POOL_USAGE: float = 0.9
+    READY_DB_TIMEOUT_MS: int = 500
+    LIVE_MAX_LOOP_LAG_MS: int = 5_000
+
+    # Token buckets, rate per second and burst, a rate of 0 disables a limit
+    RATE_LIMIT_MODE: RateLimitMode = RateLimitMode.DROP
+    RATE_LIMIT_USER_RATE: float = 10
+    RATE_LIMIT_USER_BURST: float = 20
+    RATE_LIMIT_ROOM_RATE: float = 200
+    RATE_LIMIT_ROOM_BURST: float = 400
+    # IP and login buckets are per client address. Behind a reverse proxy that is the proxy's address unless uvicorn
+    # trusts it through FORWARDED_ALLOW_IPS, and every client behind one NAT shares a bucket, raise them to what one
+    # address is expected to send (a rate of 0 if that is unbounded)
+    RATE_LIMIT_IP_RATE: float = 50
+    RATE_LIMIT_IP_BURST: float = 100
+    RATE_LIMIT_LOGIN_RATE: float = 1
+    RATE_LIMIT_LOGIN_BURST: float = 10
+    RATE_LIMIT_EVICT_INTERVAL_SECONDS: float = 60
 
     DIR: Path = Path.cwd()
     LOGS: Path = DIR / 'logs'
@@ -44,7 +185,16 @@ class ApplicationConfig(BaseSettings):
         super().__init__()
 
         if setup_logging:
-            logger.setup_logging(self.LOG_LEVEL, file_name=str(self.LOGS / f'{self.LAUNCH_FILE}.log'))
+            logger.setup_logging(
+                self.LOG_LEVEL,
+                file_name=str(self.LOGS / f'{self.LAUNCH_FILE}.log'),
+                structured=self.LOG_FORMAT is LogFormat.JSON,
+                sampling=self.LOG_SAMPLING,
+                rate_limits=self.LOG_RATE_LIMITS,
+                batch_size=self.LOG_BATCH_SIZE,
+                max_bytes=self.LOG_FILE_MAX_BYTES,
+                backup_count=self.LOG_FILE_BACKUP_COUNT,
+            )
 
 
 # Requires all Setting variables to exist in env
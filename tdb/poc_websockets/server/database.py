@@ -1,24 +1,212 @@
-from collections.abc import AsyncGenerator
+import itertools
+import logging
+import time
+from collections.abc import AsyncGenerator, Hashable
+from typing import Any, override
 
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import Select, event
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.engine.interfaces import DBAPIConnection, DBAPICursor, ExecutionContext
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry, PoolProxiedConnection
+from sqlalchemy.sql import ClauseElement
 
-from tdb.poc_websockets.server import config
+from tdb.poc_websockets.server import config, metrics
+from tdb.poc_websockets.server.cache import TTLCache
 
-engine = create_async_engine(
-    str(config.settings.ASYNC_POSTGRES_URI),
-    echo=config.settings.POSTGRES_ECHO,
-    future=True,
-    pool_size=max(5, config.settings.POSTGRES_POOL_SIZE),
+logger = logging.getLogger(__name__)
+
+RECENT_WRITES_SIZE = 10_000
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # waiting for a free connection happens inside _do_get, no pool event covers it
+    def _do_get(self) -> ConnectionPoolEntry:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.db_pool_timeouts.inc()
+            raise
+        finally:
+            metrics.db_pool_checkout_wait_seconds.observe(time.perf_counter() - start)
+
+
+def create_engine(uri: str) -> AsyncEngine:
+    options: dict[str, Any] = {}
+    if make_url(uri).drivername == 'postgresql+asyncpg':
+        # asyncpg's statement cache and the dialect's cache of prepared statements, both per connection
+        options['connect_args'] = {
+            'statement_cache_size': config.settings.POSTGRES_STATEMENT_CACHE_SIZE,
+            'prepared_statement_cache_size': config.settings.POSTGRES_STATEMENT_CACHE_SIZE,
+        }
+
+    created = create_async_engine(
+        uri,
+        echo=config.settings.POSTGRES_ECHO,
+        future=True,
+        poolclass=InstrumentedPool,
+        pool_size=max(5, config.settings.POSTGRES_POOL_SIZE),
+        max_overflow=config.settings.POSTGRES_MAX_OVERFLOW,
+        pool_timeout=config.settings.POSTGRES_POOL_TIMEOUT_SECONDS,
+        pool_pre_ping=config.settings.POSTGRES_POOL_PRE_PING,
+        pool_recycle=config.settings.POSTGRES_POOL_RECYCLE_SECONDS,
+        **options,
+    )
+
+    event.listen(created.sync_engine.pool, 'checkout', on_checkout)
+    event.listen(created.sync_engine.pool, 'checkin', on_checkin)
+    event.listen(created.sync_engine.pool, 'connect', on_connect)
+    event.listen(created.sync_engine.pool, 'invalidate', on_invalidate)
+    event.listen(created.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(created.sync_engine, 'after_cursor_execute', after_cursor_execute)
+
+    return created
+
+
+def on_checkout(_dbapi_connection: DBAPIConnection, record: ConnectionPoolEntry, _proxy: PoolProxiedConnection) -> None:
+    metrics.db_pool_checkouts.inc()
+    record.info['checked_out_at'] = time.perf_counter()
+
+
+def on_checkin(_dbapi_connection: DBAPIConnection | None, record: ConnectionPoolEntry) -> None:
+    checked_out_at = record.info.pop('checked_out_at', None)
+    if checked_out_at is not None:
+        metrics.db_pool_hold_seconds.observe(time.perf_counter() - checked_out_at)
+
+
+def on_connect(_dbapi_connection: DBAPIConnection, _record: ConnectionPoolEntry) -> None:
+    metrics.db_pool_connects.inc()
+
+
+def on_invalidate(
+    _dbapi_connection: DBAPIConnection,
+    _record: ConnectionPoolEntry,
+    _exception: BaseException | None,
+) -> None:
+    metrics.db_pool_invalidations.inc()
+
+
+def before_cursor_execute(
+    connection: Connection,
+    _cursor: DBAPICursor,
+    _statement: str,
+    _parameters: object,
+    _context: ExecutionContext | None,
+    _executemany: bool,  # noqa: FBT001
+) -> None:
+    # statements on one connection never overlap, a failed one is simply overwritten by the next
+    connection.info['query_started_at'] = time.perf_counter()
+
+
+def after_cursor_execute(
+    connection: Connection,
+    _cursor: DBAPICursor,
+    statement: str,
+    _parameters: object,
+    _context: ExecutionContext | None,
+    _executemany: bool,  # noqa: FBT001
+) -> None:
+    elapsed = time.perf_counter() - connection.info.pop('query_started_at', time.perf_counter())
+    metrics.db_query_seconds.observe(elapsed)
+
+    slow_query_ms = config.settings.POSTGRES_SLOW_QUERY_MS
+    if slow_query_ms and elapsed * 1000 >= slow_query_ms:
+        metrics.db_slow_queries.inc()
+        # the statement only, parameters can hold password hashes and message payloads
+        logger.warning('Slow query, %.1f ms: %s', elapsed * 1000, statement)
+
+
+engine = create_engine(str(config.settings.ASYNC_POSTGRES_URI))
+replicas = [create_engine(uri) for uri in config.settings.ASYNC_POSTGRES_REPLICA_URI]
+next_replica = itertools.cycle(replicas)
+
+# Rows written through this worker a moment ago, by id or any other key they are looked up by, read from the primary
+# until the replicas have caught up
+recent_writes: TTLCache[Hashable, bool] = TTLCache(
+    maxsize=RECENT_WRITES_SIZE,
+    ttl=config.settings.REPLICA_READ_YOUR_WRITES_SECONDS,
 )
 
+
+class RoutingSession(Session):
+    # Plain SELECTs go to one replica per session, picked round-robin. Everything else, and every statement once the
+    # session has written or was pinned with use_primary, goes to the primary.
+
+    @override
+    def get_bind(self, mapper: object = None, *, clause: ClauseElement | None = None, **kw: object) -> Engine:
+        if not replicas or self.info.get('primary'):
+            return engine.sync_engine
+
+        # FOR UPDATE takes locks, only the primary can
+        if self._flushing or not isinstance(clause, Select) or clause._for_update_arg is not None:  # noqa: SLF001
+            self.info['primary'] = True
+            return engine.sync_engine
+
+        replica: AsyncEngine | None = self.info.get('replica')
+        if replica is None:
+            # one replica for the whole session, reads never go back in time between two of them
+            replica = self.info['replica'] = next(next_replica)
+
+        return replica.sync_engine
+
+
 SessionLocal = async_sessionmaker(
     bind=engine,
     class_=AsyncSession,
+    sync_session_class=RoutingSession,
     autoflush=False,
     expire_on_commit=False,
 )
 
 
+def use_primary(session: AsyncSession) -> bool:
+    # read your writes, True if the session's reads were routed to a replica until now
+    if not replicas or session.info.get('primary'):
+        return False
+
+    session.info['primary'] = True
+    return True
+
+
+def wrote(*keys: Hashable) -> None:
+    for key in keys:
+        recent_writes.set(key, value=True)
+
+
+def recently_written(key: Hashable) -> bool:
+    return recent_writes.get(key) is not None
+
+
+# The primary's pool, writes and readiness depend on it, replicas only take reads
+def pool_connections() -> dict[metrics.Labels, float]:
+    pool = engine.sync_engine.pool
+    assert isinstance(pool, InstrumentedPool)  # noqa: S101
+
+    return {
+        ('checked_out',): pool.checkedout(),
+        ('idle',): pool.checkedin(),
+        ('overflow',): max(0, pool.overflow()),
+        ('size',): pool.size(),
+    }
+
+
+metrics.db_pool_connections.collect = pool_connections
+
+
+def pool_usage() -> float:
+    pool = engine.sync_engine.pool
+    assert isinstance(pool, InstrumentedPool)  # noqa: S101
+
+    # a negative max_overflow means the pool can always open another connection
+    if pool._max_overflow < 0:  # noqa: SLF001
+        return 0.0
+
+    return pool.checkedout() / (pool.size() + pool._max_overflow)  # noqa: SLF001
+
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with SessionLocal() as session:
         try:
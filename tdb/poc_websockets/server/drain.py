@@ -0,0 +1,38 @@
+import asyncio
+import socket
+from types import FrameType
+
+import uvicorn
+
+from tdb.poc_websockets.server.websocket import manager
+
+# uvicorn closes every websocket with 1012 as soon as it starts shutting down. The first SIGINT / SIGTERM drains
+# them first, spreading reconnects over the other workers, a second signal exits straight away.
+
+
+class DrainingServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config) -> None:
+        super().__init__(config)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.exiting = False
+        self._drain: asyncio.Task[None] | None = None
+
+    async def serve(self, sockets: list[socket.socket] | None = None) -> None:
+        self.loop = asyncio.get_running_loop()
+        await super().serve(sockets)
+
+    def handle_exit(self, sig: int, frame: FrameType | None) -> None:
+        if self.loop is None or self.exiting:
+            super().handle_exit(sig, frame)
+            return
+
+        self.exiting = True
+        # signal handlers run between bytecodes, hand the drain over to the loop
+        self.loop.call_soon_threadsafe(self._start_drain, sig)
+
+    def _start_drain(self, sig: int) -> None:
+        self._drain = asyncio.create_task(self._drain_then_exit(sig), name='server-drain')
+
+    async def _drain_then_exit(self, sig: int) -> None:
+        await manager.start_drain()
+        super().handle_exit(sig, None)
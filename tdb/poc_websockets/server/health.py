@@ -0,0 +1,57 @@
+import asyncio
+import contextlib
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from tdb.poc_websockets.server import database
+from tdb.poc_websockets.server.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    # how late a periodic timer fires, i.e. how long callbacks wait for the event loop
+
+    def __init__(self, *, interval: float) -> None:
+        self.interval = interval
+        self.lag = 0.0
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._measure(), name='loop-lag-monitor')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _measure(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - expected)
+
+
+async def database_reachable() -> bool:
+    # bounded by the caller, a pool or connect timeout is far longer than a readiness probe waits
+    try:
+        async with database.SessionLocal() as session:
+            await session.execute(text('SELECT 1'))
+
+    except (OSError, SQLAlchemyError):
+        logger.warning('Readiness database check failed', exc_info=True)
+        return False
+
+    return True
+
+
+loop_lag = LoopLagMonitor(interval=settings.READY_LOOP_LAG_INTERVAL_MS / 1000)
@@ -0,0 +1,139 @@
+import asyncio
+import contextlib
+import logging
+from collections import deque
+
+import uuid_utils
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from tdb.poc_websockets.server import database, metrics
+from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.models.message import Message, MessageCreate, MessageRepository
+from tdb.poc_websockets.server.protocol import Envelope
+
+logger = logging.getLogger(__name__)
+
+
+class MessageHistory:
+    def __init__(
+        self, *, size: int, flush_interval: float, flush_size: int, max_pending: int, persistent: bool
+    ) -> None:
+        self.size = size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.persistent = persistent
+
+        # Last `size` messages of every room with local members
+        self.rooms: dict[str, deque[Envelope]] = {}
+
+        # Written behind the hot path, in batches, under the id given when they were received
+        self.pending: list[tuple[uuid_utils.UUID, Envelope]] = []
+        self._flush_now = asyncio.Event()
+        self._flusher: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        self._flusher = asyncio.create_task(self._flush_loop(), name='history-flusher')
+
+    async def stop(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flusher
+
+        await self.flush()
+
+    def remember(self, message: Envelope) -> None:
+        ring = self.rooms.get(message.room)
+        if ring is not None:
+            ring.append(message)
+
+    def since(self, room: str, seq: int) -> list[Envelope]:
+        return [message for message in self.rooms.get(room, ()) if message.seq > seq]
+
+    def persist(self, message: Envelope) -> None:
+        if not self.persistent:
+            return
+
+        self.pending.append((uuid_utils.uuid7(), message))
+
+        if len(self.pending) >= self.flush_size:
+            self._flush_now.set()
+
+    def forget(self, room: str) -> None:
+        self.rooms.pop(room, None)
+
+    async def recent(self, room: str) -> list[Envelope]:
+        ring = self.rooms.get(room)
+        if ring is not None:
+            return list(ring)
+
+        # first local member of the room, fall back to postgres plus anything not flushed yet
+        messages = await self.stored(room)
+        messages.extend(message for _, message in self.pending if message.room == room)
+
+        ring = self.rooms.setdefault(room, deque(maxlen=self.size))
+        if not ring:
+            ring.extend(messages)
+
+        return list(ring)
+
+    async def stored(self, room: str) -> list[Envelope]:
+        if not self.persistent:
+            return []
+
+        async with database.SessionLocal() as session:
+            stored = await MessageRepository(session=session).latest(room, limit=self.size)
+
+        return [message.to_envelope() for message in stored]
+
+    async def flush(self) -> bool:
+        # False when the batch could not be written and was queued again
+        if not self.pending:
+            return True
+
+        batch, self.pending = self.pending, []
+        rows = [{'id': ident, **MessageCreate.from_envelope(message).model_dump()} for ident, message in batch]
+
+        try:
+            # executemany is sent as multi-row INSERTs
+            async with database.SessionLocal() as session:
+                await session.execute(insert(Message), rows)
+                await session.commit()
+
+        except (OSError, SQLAlchemyError):
+            logger.exception('Failed to persist %d messages, retrying', len(batch))
+            metrics.history_write_failures.inc()
+
+            # ahead of anything persisted meanwhile, so ids stay in insert order
+            self.pending = batch + self.pending
+            lost = len(self.pending) - self.max_pending
+            if lost > 0:
+                del self.pending[:lost]
+                metrics.history_messages_lost.inc(lost)
+                logger.warning('Dropped %d unwritten messages past HISTORY_MAX_PENDING', lost)
+
+            return False
+
+        return True
+
+    async def _flush_loop(self) -> None:
+        while True:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+
+            self._flush_now.clear()
+            if not await self.flush():
+                # a full queue asks for a flush on every message, wait out the interval before retrying
+                await asyncio.sleep(self.flush_interval)
+
+
+def create_history() -> MessageHistory:
+    return MessageHistory(
+        size=settings.HISTORY_SIZE,
+        flush_interval=settings.HISTORY_FLUSH_INTERVAL_MS / 1000,
+        flush_size=settings.HISTORY_FLUSH_SIZE,
+        max_pending=settings.HISTORY_MAX_PENDING,
+        persistent=settings.HISTORY_PERSIST,
+    )
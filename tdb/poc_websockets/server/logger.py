@@ -1,7 +1,14 @@
+import copy
+import json
 import logging.handlers
 import sys
+import threading
+import time
+import traceback
+from collections.abc import Mapping
 from logging import LogRecord
-from queue import Queue
+from queue import Empty, Queue
+from typing import TextIO
 
 FORMAT = '%(asctime)s | %(levelname)8s | %(name)20s | %(message)s | %(filename)s:%(lineno)d (%(funcName)s)'
 
@@ -11,43 +18,256 @@ LOG_LEVELS = {
 }
 
 
-def setup_logging(level: str, file_name: str) -> None:
-    basic_formatter = logging.Formatter(FORMAT)
+class TextFormatter(logging.Formatter):
+    def format(self, record: LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{text} | {suppressed} suppressed' if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line
+    def format(self, record: LogRecord) -> str:
+        entry: dict[str, object] = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': f'{record.filename}:{record.lineno}',
+        }
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Per logger, children included: the fraction of records below WARNING kept, and a cap in records per second
+    # for everything below ERROR. Runs on the logging thread, so it is kept to a dict lookup and a little arithmetic.
+
+    def __init__(self, *, sampling: Mapping[str, float], rate_limits: Mapping[str, float]) -> None:
+        super().__init__()
+        self.sampling = dict(sampling)
+        self.rate_limits = dict(rate_limits)
+
+        # resolved per logger name, (sample rate, records per second)
+        self.rules: dict[str, tuple[float, float]] = {}
+        self.counters: dict[str, int] = {}
+        # cap buckets: tokens, last refill, records dropped since the last one let through
+        self.buckets: dict[str, list[float]] = {}
+
+    def rule(self, name: str) -> tuple[float, float]:
+        rule = self.rules.get(name)
+        if rule is None:
+            rule = self.rules[name] = (self.lookup(self.sampling, name, 1.0), self.lookup(self.rate_limits, name, 0.0))
+
+        return rule
+
+    @staticmethod
+    def lookup(values: Mapping[str, float], name: str, default: float) -> float:
+        while True:
+            if name in values:
+                return values[name]
+
+            if '.' not in name:
+                return default
+
+            name = name.rsplit('.', 1)[0]
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+
+        sample, rate = self.rule(record.name)
+
+        if sample < 1 and record.levelno < logging.WARNING:
+            if sample <= 0:
+                return False
+
+            # deterministic, every n-th record rather than random
+            count = self.counters[record.name] = self.counters.get(record.name, 0) + 1
+            if count % round(1 / sample):
+                return False
+
+        if rate > 0:
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(record.name, [rate, now, 0])
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = int(bucket[2])
+                bucket[2] = 0
+
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats every message on the calling thread. Only the traceback, which holds frames, is
+    # rendered here, the message is formatted on the writer thread, so arguments must not be mutated after logging.
+    def prepare(self, record: LogRecord) -> LogRecord:
+        record = copy.copy(record)
+
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+class BatchFileHandler(logging.handlers.RotatingFileHandler):
+    def write_batch(self, text: str) -> None:
+        # None once closed, reopened as emit would
+        if self.stream is None:
+            self.stream = self._open()
+
+        if self.maxBytes and self.stream.tell() + len(text) >= self.maxBytes:
+            self.doRollover()
+
+        self.stream.write(text)
+        self.stream.flush()
+
+
+class LogWriter:
+    # Drains the queue in batches, formats on its own thread and writes each destination once per batch
+
+    def __init__(
+        self,
+        queue: 'Queue[LogRecord | None]',
+        formatter: logging.Formatter,
+        *,
+        file_handler: BatchFileHandler,
+        stdout: TextIO | None,
+        batch_size: int,
+    ) -> None:
+        self.queue = queue
+        self.formatter = formatter
+        self.file_handler = file_handler
+        self.stdout = stdout
+        self.batch_size = batch_size
+
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        # everything queued before the sentinel is written
+        self.queue.put(None)
+        self._thread.join()
+        self.file_handler.close()
+
+    def write(self, records: list[LogRecord]) -> None:
+        text = ''.join(f'{self.formatter.format(record)}\n' for record in records)
+
+        self.file_handler.write_batch(text)
+        if self.stdout is not None:
+            self.stdout.write(text)
+            self.stdout.flush()
+
+    def _run(self) -> None:
+        while True:
+            records: list[LogRecord] = []
+            record = self.queue.get()
+
+            while record is not None:
+                records.append(record)
+                if len(records) >= self.batch_size:
+                    break
+
+                try:
+                    record = self.queue.get_nowait()
+                except Empty:
+                    break
+
+            if records:
+                try:
+                    self.write(records)
+                except Exception:  # noqa: BLE001
+                    # a failing destination must not kill the writer, everything after it would be lost
+                    traceback.print_exc(file=sys.stderr)
+
+            if record is None:
+                return
+
+
+writer: LogWriter | None = None
+queue_handler: LazyQueueHandler | None = None
+
+
+def setup_logging(
+    level: str,
+    file_name: str,
+    *,
+    structured: bool = False,
+    sampling: Mapping[str, float] | None = None,
+    rate_limits: Mapping[str, float] | None = None,
+    batch_size: int = 512,
+    max_bytes: int = 1024 * 1024,
+    backup_count: int = 5,
+    stdout: bool = True,
+) -> None:
+    global writer, queue_handler  # noqa: PLW0603
+
+    formatter = JsonFormatter() if structured else TextFormatter(FORMAT)
 
     root_logger = logging.getLogger()
     root_logger.setLevel(level)
 
-    # Create a queue
-    queue: Queue[LogRecord] = Queue(-1)
+    # records are filtered and enqueued on the logging thread, formatted and written on the writer thread
+    queue: Queue[LogRecord | None] = Queue(-1)
 
-    # Create a QueueHandler and attach it to the logger
-    queue_handler = logging.handlers.QueueHandler(queue)
+    queue_handler = LazyQueueHandler(queue)
     queue_handler.setLevel(level)
+    queue_handler.addFilter(SamplingFilter(sampling=sampling or {}, rate_limits=rate_limits or {}))
 
     root_logger.addHandler(queue_handler)
 
-    # Create a QueueListener with RotatingFileHandler and StreamHandler
-    file_handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=1024 * 1024, backupCount=5)
-    file_handler.setFormatter(basic_formatter)
-    file_handler.setLevel(level)
+    file_handler = BatchFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+    writer = LogWriter(
+        queue,
+        formatter,
+        file_handler=file_handler,
+        stdout=sys.stdout if stdout else None,
+        batch_size=batch_size,
+    )
+    writer.start()
+
+
+def stop_logging() -> None:
+    global writer  # noqa: PLW0603
+
+    if writer is None or queue_handler is None:
+        return
+
+    # anything logged after this, such as the server's own shutdown messages, is written directly
+    logging.getLogger().removeHandler(queue_handler)
+    writer.stop()
 
     stream_handler = logging.StreamHandler(stream=sys.stdout)
-    stream_handler.setFormatter(basic_formatter)
-    stream_handler.setLevel(level)
+    stream_handler.setFormatter(writer.formatter)
+    stream_handler.setLevel(queue_handler.level)
+    logging.getLogger().addHandler(stream_handler)
 
-    queue_listener = logging.handlers.QueueListener(queue, file_handler, stream_handler)
-    queue_listener.start()
+    writer = None
 
 
 def force_logging() -> None:
-    root_logger = logging.getLogger()
-
-    # remove every other logger's handlers
-    # and propagate to root logger
+    # drop every other logger's handlers, so all records go through the root logger's queue once
     for name in logging.root.manager.loggerDict:
         logger = logging.getLogger(name)
-        logger.handlers = root_logger.handlers
-        logger.propagate = False
+        logger.handlers.clear()
+        logger.propagate = True
 
     # set specific log levels for modules
     for name, level in LOG_LEVELS.items():
@@ -0,0 +1,170 @@
+import bisect
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+# Prometheus text exposition, recorded from the event loop thread only so nothing needs a lock.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+Labels = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Metric(ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, *, labels: Labels = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+        registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterator[tuple[str, Labels, float]]: ...
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+
+        for name, values, value in self.samples():
+            if values:
+                pairs = ','.join(f'{label}="{escape(str(v))}"' for label, v in zip(self.labels, values, strict=False))
+                yield f'{name}{{{pairs}}} {value}'
+            else:
+                yield f'{name} {value}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, *, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels=labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, *values: str) -> None:
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        for values, value in self.values.items():
+            yield self.name, values, value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        *,
+        labels: Labels = (),
+        collect: Callable[[], dict[Labels, float]] | None = None,
+    ) -> None:
+        super().__init__(name, documentation, labels=labels)
+        self.values: dict[Labels, float] = {}
+        # computed on scrape instead of being kept up to date on the hot path
+        self.collect = collect
+
+    def set(self, value: float, *values: str) -> None:
+        self.values[values] = value
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        values = self.collect() if self.collect is not None else self.values
+        for labels, value in values.items():
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, *, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels=('le',))
+        self.buckets = buckets
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts, strict=True):
+            cumulative += count
+            yield f'{self.name}_bucket', (str(bound),), cumulative
+
+        yield f'{self.name}_sum', (), self.sum
+        yield f'{self.name}_count', (), cumulative
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+registry: list[Metric] = []
+
+# websockets
+# per room detail is left to the authenticated presence endpoints, a label per room would be unbounded
+websocket_connections = Gauge('websocket_connections', 'Open websockets')
+websocket_rooms = Gauge('websocket_rooms', 'Rooms with at least one open websocket')
+websocket_messages_in = Counter('websocket_messages_in_total', 'Messages received from clients')
+websocket_messages_out = Counter('websocket_messages_out_total', 'Frames queued for clients')
+websocket_messages_dropped = Counter('websocket_messages_dropped_total', 'Frames dropped for slow consumers')
+websocket_messages_limited = Counter('websocket_messages_limited_total', 'Messages dropped or throttled by rate limits')
+websocket_send_queue_depth = Gauge(
+    'websocket_send_queue_depth',
+    'Frames waiting in send queues, total and deepest connection',
+    labels=('stat',),
+)
+websocket_idle_evictions = Counter('websocket_idle_evictions_total', 'Websockets closed for missing heartbeats')
+broadcast_fanout_seconds = Histogram('broadcast_fanout_seconds', 'Time to queue a message for every local member')
+websocket_draining = Gauge('websocket_draining', '1 while this worker is draining its websockets')
+websocket_batched_rooms = Gauge('websocket_batched_rooms', 'Rooms delivering messages in batches')
+websocket_batches = Counter('websocket_batches_total', 'Batches flushed to batched rooms')
+websocket_batch_size = Histogram(
+    'websocket_batch_size',
+    'Messages per batch',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+# history
+history_write_failures = Counter('history_write_failures_total', 'History batches that failed to write')
+history_messages_lost = Counter('history_messages_lost_total', 'Messages dropped past HISTORY_MAX_PENDING unwritten')
+
+# database pool
+db_pool_checkouts = Counter('db_pool_checkouts_total', 'Connections checked out of the pool')
+db_pool_checkout_wait_seconds = Histogram('db_pool_checkout_wait_seconds', 'Time waiting for a pool connection')
+db_pool_connections = Gauge('db_pool_connections', 'Pool connections by state', labels=('state',))
+db_pool_hold_seconds = Histogram('db_pool_hold_seconds', 'Time a connection stays checked out')
+db_pool_timeouts = Counter('db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection')
+db_pool_connects = Counter('db_pool_connects_total', 'Connections opened, for overflow, recycling or replacements')
+db_pool_invalidations = Counter('db_pool_invalidations_total', 'Connections discarded as broken, pre-ping included')
+db_query_seconds = Histogram('db_query_seconds', 'Time to execute a statement')
+db_slow_queries = Counter('db_slow_queries_total', 'Statements slower than POSTGRES_SLOW_QUERY_MS')
+
+# auth
+jwt_decode_seconds = Histogram('jwt_decode_seconds', 'Time to verify and decode an access token')
+token_cache_lookups = Counter('token_cache_lookups_total', 'Verified token cache lookups', labels=('result',))
+tokens_denied = Counter('tokens_denied_total', 'Valid tokens refused as revoked')
+password_hash_seconds = Histogram(
+    'password_hash_seconds',
+    'Time for a bcrypt hash or check, including the worker queue',
+    buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2.5, 5, 10),
+)
@@ -1,12 +1,20 @@
+from collections.abc import Hashable, Mapping, Sequence
 from datetime import UTC, datetime
-from typing import Generic, Self, TypeVar
+from typing import TYPE_CHECKING, Any, Generic, Self, TypeVar
 from uuid import UUID
 
 import uuid_utils
 from pydantic import BaseModel
-from sqlalchemy import Column, DateTime
+from sqlalchemy import Column, DateTime, delete, insert, inspect, update
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlmodel import Field, SQLModel, select
+from sqlmodel import Field, SQLModel, col, select
+from sqlmodel.sql.expression import SelectOfScalar
+
+from tdb.poc_websockets.server import database
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Mapper
 
 
 class IdMixin(SQLModel):
@@ -55,28 +63,104 @@ class BaseRepository(Generic[CreateModel, UpdateModel, TableModel]):
     def __init__(self, *, session: AsyncSession) -> None:
         self.session = session
 
-    async def create(self, model: CreateModel) -> TableModel:
+    # Every write is one statement, rows come back through RETURNING instead of a SELECT before or after
+    def row(self, model: CreateModel) -> dict[str, Any]:
+        # column values read from the table model, model_dump may mask fields such as passwords
         table_model: TableModel = self.table_model.model_validate(model)
-        self.session.add(table_model)
+        mapper: Mapper[TableModel] = inspect(self.table_model, raiseerr=True)
+        return {column.key: getattr(table_model, column.key) for column in mapper.column_attrs}
+
+    def changes(self, model: UpdateModel) -> dict[str, Any]:
+        return model.model_dump(exclude_unset=True, exclude={'id'})
+
+    async def create(self, model: CreateModel) -> TableModel:
+        statement = insert(self.table_model).values(self.row(model)).returning(self.table_model)
+        table_model = (await self.session.scalars(statement)).one()
         await self.session.commit()
-        await self.session.refresh(table_model)
+        database.wrote(table_model.id)
         return table_model
 
+    # Reads may be served by a replica, see database.RoutingSession. Rows written moments ago are read from the primary,
+    # and a row missing on the replica is looked for there once more, it may not have replicated yet.
+    async def one(self, statement: SelectOfScalar[TableModel], *, key: Hashable) -> TableModel:
+        if database.recently_written(key):
+            database.use_primary(self.session)
+
+        try:
+            return (await self.session.scalars(statement)).one()
+        except NoResultFound:
+            if not database.use_primary(self.session):
+                raise
+
+        return (await self.session.scalars(statement)).one()
+
     async def read(self, ident: UUID) -> TableModel:
         statement = select(self.table_model).where(self.table_model.id == ident)
-        result = await self.session.execute(statement)
-        return result.scalars().one()
+        return await self.one(statement, key=ident)
 
     async def update(self, ident: UUID, model: UpdateModel) -> TableModel:
-        table_model = await self.read(ident)
-        table_model.update(model)
-        self.session.add(table_model)
+        changes = self.changes(model)
+        if not changes:
+            return await self.read(ident)
+
+        statement = (
+            update(self.table_model)
+            .where(col(self.table_model.id) == ident)
+            .values(changes)
+            .returning(self.table_model)
+            .execution_options(populate_existing=True)
+        )
+        table_model = (await self.session.scalars(statement)).one()
         await self.session.commit()
-        await self.session.refresh(table_model)
+        database.wrote(ident)
 
         return table_model
 
     async def delete(self, ident: UUID) -> None:
-        table_model = await self.read(ident)
-        await self.session.delete(table_model)
+        ident_column = col(self.table_model.id)
+        statement = delete(self.table_model).where(ident_column == ident).returning(ident_column)
+        (await self.session.scalars(statement)).one()
+        await self.session.commit()
+        database.wrote(ident)
+
+    async def bulk_create(self, models: Sequence[CreateModel]) -> list[TableModel]:
+        if not models:
+            return []
+
+        # executemany, sent as batched multi-row INSERT ... RETURNING
+        statement = insert(self.table_model).returning(self.table_model)
+        table_models = list(await self.session.scalars(statement, [self.row(model) for model in models]))
+        await self.session.commit()
+        database.wrote(*(table_model.id for table_model in table_models))
+
+        return table_models
+
+    async def bulk_update(self, models: Mapping[UUID, UpdateModel]) -> list[TableModel]:
+        rows = [{**changes, 'id': ident} for ident, model in models.items() if (changes := self.changes(model))]
+
+        # bulk UPDATE by primary key has no RETURNING, one SELECT reads every row back instead of one per row
+        if rows:
+            await self.session.execute(update(self.table_model), rows)
+
+        statement = (
+            select(self.table_model)
+            .where(col(self.table_model.id).in_(list(models)))
+            .execution_options(populate_existing=True)
+        )
+        table_models = list(await self.session.scalars(statement))
         await self.session.commit()
+        database.wrote(*models)
+
+        return table_models
+
+    async def bulk_delete(self, idents: Sequence[UUID]) -> list[UUID]:
+        if not idents:
+            return []
+
+        ident_column = col(self.table_model.id)
+        statement = delete(self.table_model).where(ident_column.in_(idents)).returning(ident_column)
+        deleted = list(await self.session.scalars(statement))
+        await self.session.commit()
+        database.wrote(*deleted)
+
+        return deleted
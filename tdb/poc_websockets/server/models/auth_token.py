@@ -1,3 +1,5 @@
+from uuid import UUID
+
 from pydantic import BaseModel
 
 
@@ -8,3 +10,14 @@ class Token(BaseModel):
 
 class Logout(BaseModel):
     logout: bool = True
+
+
+class TokenUser(BaseModel):
+    # the user as of when the token was issued, read from verified claims
+    id: UUID
+    email: str
+    disabled: bool
+    # None for tokens issued before these claims existed
+    jti: str | None
+    issued_at: float
+    expires_at: float
@@ -0,0 +1,57 @@
+from datetime import UTC, datetime
+from uuid import UUID
+
+from sqlalchemy import VARCHAR, Column, DateTime, Index, LargeBinary
+from sqlmodel import Field, SQLModel, col, select
+
+from tdb.poc_websockets.server.models import BaseIdModel, BaseRepository
+from tdb.poc_websockets.server.protocol import Envelope, Kind
+
+
+class MessageBase(SQLModel):
+    room: str = Field(sa_column=Column(VARCHAR, nullable=False))
+    sender: str = Field(sa_column=Column(VARCHAR, nullable=False))
+    sender_id: UUID
+    payload: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    sent_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+
+
+class MessageCreate(MessageBase):
+    @classmethod
+    def from_envelope(cls, envelope: Envelope) -> 'MessageCreate':
+        return cls(
+            room=envelope.room,
+            sender=envelope.sender,
+            sender_id=envelope.sender_id,
+            payload=envelope.payload,
+            sent_at=datetime.fromtimestamp(envelope.timestamp, UTC),
+        )
+
+
+class Message(BaseIdModel, MessageBase, table=True):
+    # ids are uuid7, so (room, id) returns a room's latest messages straight off the index
+    __table_args__ = (Index('ix_message_room_id', 'room', 'id'),)
+
+    def to_envelope(self) -> Envelope:
+        return Envelope(
+            kind=Kind.MESSAGE,
+            room=self.room,
+            sender=self.sender,
+            payload=self.payload,
+            sender_id=self.sender_id,
+            timestamp=self.sent_at.timestamp(),
+        )
+
+
+class MessageRepository(BaseRepository[MessageCreate, MessageCreate, Message]):
+    table_model = Message
+
+    async def latest(self, room: str, *, limit: int) -> list[Message]:
+        statement = (
+            select(self.table_model)
+            .where(self.table_model.room == room)
+            .order_by(col(self.table_model.id).desc())
+            .limit(limit)
+        )
+        result = await self.session.execute(statement)
+        return list(reversed(result.scalars().all()))
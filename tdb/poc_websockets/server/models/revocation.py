@@ -0,0 +1,32 @@
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import VARCHAR, Column, DateTime, delete
+from sqlmodel import Field, SQLModel, col, select
+
+from tdb.poc_websockets.server.models import BaseIdModel, BaseRepository
+
+
+class RevocationBase(SQLModel):
+    # either one token by its jti, or every token of a user issued up to revoked_at
+    jti: str | None = Field(default=None, sa_column=Column(VARCHAR, nullable=True))
+    user_id: UUID | None = None
+    revoked_at: datetime = Field(sa_column=Column(DateTime(timezone=True), index=True, nullable=False))
+    # once every token it covers has expired the row is dropped
+    expires_at: datetime = Field(sa_column=Column(DateTime(timezone=True), index=True, nullable=False))
+
+
+class Revocation(BaseIdModel, RevocationBase, table=True):
+    pass
+
+
+class RevocationRepository(BaseRepository[RevocationBase, RevocationBase, Revocation]):
+    table_model = Revocation
+
+    async def since(self, revoked_at: datetime) -> list[Revocation]:
+        statement = select(self.table_model).where(col(self.table_model.revoked_at) >= revoked_at)
+        return list(await self.session.scalars(statement))
+
+    async def purge(self, now: datetime) -> None:
+        await self.session.execute(delete(self.table_model).where(col(self.table_model.expires_at) <= now))
+        await self.session.commit()
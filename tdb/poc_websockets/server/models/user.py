@@ -1,8 +1,16 @@
-from pydantic import EmailStr, field_serializer
-from sqlalchemy import VARCHAR, Column
-from sqlmodel import Field, SQLModel, select
+import asyncio
+from collections.abc import AsyncIterator, Mapping, Sequence
+from uuid import UUID
 
+from pydantic import BaseModel, EmailStr, field_serializer
+from sqlalchemy import VARCHAR, Column, Index
+from sqlmodel import Field, SQLModel, col, select
+from sqlmodel.sql.expression import SelectOfScalar
+
+from tdb.poc_websockets.server import database
+from tdb.poc_websockets.server.cache import user_cache
 from tdb.poc_websockets.server.models import BaseIdModel, BaseRepository, TimestampMixin
+from tdb.poc_websockets.server.revocation import deny_list
 
 
 class UserBase(SQLModel):
@@ -22,11 +30,20 @@ class UserRead(BaseIdModel, UserDefault, TimestampMixin):
     pass
 
 
+class UserPage(BaseModel):
+    users: list[UserRead]
+    # pass as `after` for the next page, None on the last one
+    cursor: UUID | None
+
+
 class UserUpdate(BaseIdModel, UserCreate, TimestampMixin):
-    pass
+    disabled: bool = False
 
 
 class User(BaseIdModel, UserCreate, TimestampMixin, table=True):
+    # byte-wise comparisons, so a LIKE prefix is an index range whatever the database collation
+    __table_args__ = (Index('ix_user_name_pattern', 'name', postgresql_ops={'name': 'text_pattern_ops'}),)
+
     disabled: bool = False
 
     @field_serializer('password', when_used='always')
@@ -34,16 +51,98 @@ class User(BaseIdModel, UserCreate, TimestampMixin, table=True):
         return '*****'
 
 
+async def hash_passwords(models: Sequence[UserCreate | UserUpdate]) -> None:
+    from tdb.poc_websockets.server.auth import get_password_hash, password_pool
+
+    # only passwords being set, a few at a time so logins still find room in the password pool
+    models = [model for model in models if 'password' in model.model_fields_set]
+    for start in range(0, len(models), password_pool.max_workers):
+        batch = models[start : start + password_pool.max_workers]
+        hashes = await asyncio.gather(*(get_password_hash(model.password) for model in batch))
+
+        for model, hashed in zip(batch, hashes, strict=True):
+            model.password = hashed
+
+
+def disabling(model: UserUpdate, table_model: User) -> bool:
+    return 'disabled' in model.model_fields_set and table_model.disabled
+
+
 class UserRepository(BaseRepository[UserCreate, UserUpdate, User]):
     table_model = User
 
+    # users are also looked up by email, which has to be read back from the primary as well
     async def create(self, model: UserCreate) -> User:
-        from tdb.poc_websockets.server.auth import get_password_hash
-
-        model.password = get_password_hash(model.password)
-        return await super().create(model)
+        await hash_passwords([model])
+        table_model = await super().create(model)
+        database.wrote(table_model.email)
+        return table_model
+
+    # tokens authorize without a lookup, disabling or deleting a user revokes every token issued to it
+    async def update(self, ident: UUID, model: UserUpdate) -> User:
+        await hash_passwords([model])
+        table_model = await super().update(ident, model)
+        user_cache.invalidate(ident)
+        database.wrote(table_model.email)
+
+        if disabling(model, table_model):
+            await deny_list.revoke_users(self.session, [ident])
+
+        return table_model
+
+    async def delete(self, ident: UUID) -> None:
+        await super().delete(ident)
+        user_cache.invalidate(ident)
+        await deny_list.revoke_users(self.session, [ident])
+
+    async def bulk_create(self, models: Sequence[UserCreate]) -> list[User]:
+        await hash_passwords(models)
+        table_models = await super().bulk_create(models)
+        database.wrote(*(table_model.email for table_model in table_models))
+        return table_models
+
+    async def bulk_update(self, models: Mapping[UUID, UserUpdate]) -> list[User]:
+        await hash_passwords(list(models.values()))
+        table_models = await super().bulk_update(models)
+        for ident in models:
+            user_cache.invalidate(ident)
+        database.wrote(*(table_model.email for table_model in table_models))
+
+        disabled = [table_model.id for table_model in table_models if disabling(models[table_model.id], table_model)]
+        if disabled:
+            await deny_list.revoke_users(self.session, disabled)
+
+        return table_models
+
+    async def bulk_delete(self, idents: Sequence[UUID]) -> list[UUID]:
+        deleted = await super().bulk_delete(idents)
+        for ident in deleted:
+            user_cache.invalidate(ident)
+        await deny_list.revoke_users(self.session, deleted)
+        return deleted
+
+    def search(self, *, name: str | None = None, after: UUID | None = None) -> SelectOfScalar[User]:
+        # keyset on the uuid7 id, creation ordered, so a page never rescans the rows before it the way OFFSET does
+        statement = select(self.table_model).order_by(col(self.table_model.id))
+
+        if after is not None:
+            statement = statement.where(col(self.table_model.id) > after)
+
+        if name:
+            # served by ix_user_name_pattern
+            statement = statement.where(col(self.table_model.name).startswith(name, autoescape=True))
+
+        return statement
+
+    async def page(self, *, limit: int, name: str | None = None, after: UUID | None = None) -> list[User]:
+        return list(await self.session.scalars(self.search(name=name, after=after).limit(limit)))
+
+    async def stream(self, *, partition: int, name: str | None = None) -> AsyncIterator[Sequence[User]]:
+        # server side cursor, only one partition of rows is held at a time
+        result = await self.session.stream_scalars(self.search(name=name).execution_options(yield_per=partition))
+        async for users in result.partitions():
+            yield users
 
     async def get_by_email(self, email: str) -> User:
         statement = select(self.table_model).where(self.table_model.email == email)
-        result = await self.session.execute(statement)
-        return result.scalars().one()
+        return await self.one(statement, key=email)
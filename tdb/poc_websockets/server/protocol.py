@@ -0,0 +1,179 @@
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+from enum import IntEnum, StrEnum
+from uuid import UUID
+
+# Opt-in binary subprotocol, negotiated through Sec-WebSocket-Protocol
+SUBPROTOCOL = 'tdb.envelope.v1'
+# The same envelopes, each frame prefixed with a flag byte and deflated past a size threshold
+SUBPROTOCOL_DEFLATE = 'tdb.envelope.v1.deflate'
+
+VERSION = 1
+
+# version, kind, seq, timestamp (microseconds), sender id, room length, sender length
+HEADER = struct.Struct('!BBQQ16sHH')
+# length prefix of every envelope packed into a BATCH payload
+LENGTH = struct.Struct('!I')
+
+NIL_ID = UUID(int=0)
+
+RAW = b'\x00'
+DEFLATED = b'\x01'
+# a small deflated frame must not inflate without bound
+MAX_INFLATED_SIZE = 1 << 20
+
+
+class WireFormat(StrEnum):
+    TEXT = 'text'
+    BINARY = 'binary'
+    DEFLATE = 'deflate'
+
+    @property
+    def envelopes(self) -> bool:
+        return self is not WireFormat.TEXT
+
+
+class Kind(IntEnum):
+    MESSAGE = 0
+    SYSTEM = 1
+    # server -> client: stream epoch (payload) and last sequence number (seq) of the room
+    SYNC = 2
+    # server -> client: resume_from is no longer in the replay window, full history follows
+    RESYNC = 3
+    # server -> client heartbeat, answered with PONG
+    PING = 4
+    PONG = 5
+    # server -> client: several envelopes in one frame, each length prefixed in the payload
+    BATCH = 6
+    # server -> client: the server is going away, reconnect after the delay in the payload (seconds, ascii)
+    RECONNECT = 7
+    # server -> client: sequence number (seq) given to the client's own message, which is not echoed back
+    ACK = 8
+
+
+@dataclass(frozen=True, slots=True)
+class Envelope:
+    kind: Kind
+    room: str
+    sender: str
+    payload: bytes
+    sender_id: UUID = NIL_ID
+    seq: int = 0
+    timestamp: float = field(default_factory=time.time)
+
+    @classmethod
+    def message(
+        cls,
+        payload: bytes,
+        /,
+        *,
+        room: str,
+        sender: str,
+        sender_id: UUID = NIL_ID,
+    ) -> 'Envelope':
+        # stamped with the time the server received it, whatever the client sent
+        return cls(Kind.MESSAGE, room, sender, payload, sender_id)
+
+    @classmethod
+    def system(cls, text: str, /, *, room: str, sender: str = '') -> 'Envelope':
+        return cls(Kind.SYSTEM, room, sender, text.encode('utf-8'))
+
+    @classmethod
+    def control(cls, kind: Kind, /, *, room: str, seq: int = 0, payload: bytes = b'') -> 'Envelope':
+        return cls(kind, room, '', payload, seq=seq)
+
+    @classmethod
+    def batch(cls, messages: list['Envelope'], /, *, room: str) -> 'Envelope':
+        payload = b''.join(LENGTH.pack(len(data)) + data for data in map(encode, messages))
+        return cls(Kind.BATCH, room, '', payload, seq=messages[-1].seq)
+
+    def unbatch(self) -> list['Envelope']:
+        messages = []
+
+        offset = 0
+        while offset < len(self.payload):
+            (length,) = LENGTH.unpack_from(self.payload, offset)
+            offset += LENGTH.size
+            messages.append(decode(self.payload[offset : offset + length]))
+            offset += length
+
+        return messages
+
+    def text(self) -> str:
+        body = self.payload.decode('utf-8', errors='replace')
+
+        if self.kind is Kind.MESSAGE:
+            return f'{self.sender}: {body}'
+
+        return body
+
+
+def encode(envelope: Envelope) -> bytes:
+    room = envelope.room.encode('utf-8')
+    sender = envelope.sender.encode('utf-8')
+
+    header = HEADER.pack(
+        VERSION,
+        envelope.kind,
+        envelope.seq,
+        int(envelope.timestamp * 1_000_000),
+        envelope.sender_id.bytes,
+        len(room),
+        len(sender),
+    )
+    return b''.join((header, room, sender, envelope.payload))
+
+
+def deflate(data: bytes, /, *, min_size: int, level: int) -> bytes:
+    # raw deflate without context takeover, so one compressed frame can be shared by every recipient
+    if len(data) >= min_size:
+        compressed = zlib.compress(data, level, wbits=-zlib.MAX_WBITS)
+        if len(compressed) < len(data):
+            return DEFLATED + compressed
+
+    return RAW + data
+
+
+def inflate(frame: bytes, /, *, max_size: int = MAX_INFLATED_SIZE) -> bytes:
+    flag, data = frame[:1], frame[1:]
+    if flag == RAW:
+        return data
+
+    if flag != DEFLATED:
+        msg = f'Unsupported frame flag: {flag!r}'
+        raise ValueError(msg)
+
+    inflater = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    data = inflater.decompress(data, max_size)
+    if inflater.unconsumed_tail or not inflater.eof:
+        msg = f'Deflated frame is truncated or inflates past {max_size} bytes'
+        raise ValueError(msg)
+
+    return data
+
+
+def decode(data: bytes) -> Envelope:
+    version, kind, seq, timestamp, sender_id, room_length, sender_length = HEADER.unpack_from(data)
+
+    if version != VERSION:
+        msg = f'Unsupported envelope version: {version}'
+        raise ValueError(msg)
+
+    offset = HEADER.size
+    room = data[offset : offset + room_length].decode('utf-8')
+
+    offset += room_length
+    sender = data[offset : offset + sender_length].decode('utf-8')
+
+    offset += sender_length
+    return Envelope(
+        kind=Kind(kind),
+        room=room,
+        sender=sender,
+        payload=data[offset:],
+        sender_id=UUID(bytes=sender_id),
+        seq=seq,
+        timestamp=timestamp / 1_000_000,
+    )
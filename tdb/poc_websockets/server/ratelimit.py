@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import time
+
+from tdb.poc_websockets.server.config import settings
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    # `rate` tokens per second up to `burst`, a rate of 0 disables the limiter
+
+    def __init__(self, *, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def _bucket(self, key: str, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+
+        return bucket
+
+    def wait(self, key: str) -> float:
+        # seconds until a token is available, without taking it
+        if not self.rate:
+            return 0.0
+
+        bucket = self._bucket(key, time.monotonic())
+        return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / self.rate
+
+    def take(self, key: str) -> None:
+        if self.rate:
+            self._bucket(key, time.monotonic()).tokens -= 1
+
+    def allow(self, key: str) -> bool:
+        if self.wait(key):
+            return False
+
+        self.take(key)
+        return True
+
+    def evict(self) -> None:
+        # a bucket idle long enough to have refilled is the same as no bucket
+        if not self.rate:
+            return
+
+        cutoff = time.monotonic() - self.burst / self.rate
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.updated > cutoff}
+
+
+class RateLimits:
+    def __init__(self) -> None:
+        self.mode = settings.RATE_LIMIT_MODE
+
+        self.user = RateLimiter(rate=settings.RATE_LIMIT_USER_RATE, burst=settings.RATE_LIMIT_USER_BURST)
+        self.room = RateLimiter(rate=settings.RATE_LIMIT_ROOM_RATE, burst=settings.RATE_LIMIT_ROOM_BURST)
+        self.ip = RateLimiter(rate=settings.RATE_LIMIT_IP_RATE, burst=settings.RATE_LIMIT_IP_BURST)
+        self.login = RateLimiter(rate=settings.RATE_LIMIT_LOGIN_RATE, burst=settings.RATE_LIMIT_LOGIN_BURST)
+
+        self._evictor: asyncio.Task[None] | None = None
+
+    def wait(self, *, user: str, room: str, ip: str) -> float:
+        return max(self.user.wait(user), self.room.wait(room), self.ip.wait(ip))
+
+    def take(self, *, user: str, room: str, ip: str) -> None:
+        self.user.take(user)
+        self.room.take(room)
+        self.ip.take(ip)
+
+    def start(self) -> None:
+        self._evictor = asyncio.create_task(self._evict(), name='rate-limit-evictor')
+
+    async def stop(self) -> None:
+        if self._evictor is not None:
+            self._evictor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._evictor
+
+    async def _evict(self) -> None:
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_EVICT_INTERVAL_SECONDS)
+
+            for limiter in (self.user, self.room, self.ip, self.login):
+                limiter.evict()
+
+
+limits = RateLimits()
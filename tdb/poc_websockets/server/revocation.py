@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections.abc import Iterable, Sequence
+from datetime import UTC, datetime, timedelta
+from uuid import UUID
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tdb.poc_websockets.server import database
+from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.models.auth_token import TokenUser
+from tdb.poc_websockets.server.models.revocation import RevocationBase, RevocationRepository
+
+logger = logging.getLogger(__name__)
+
+# rows are stamped by whichever worker revoked, and can commit a little after their timestamp, so each sync reads
+# back over this much of the previous one, applying a revocation twice is harmless
+SYNC_OVERLAP = timedelta(seconds=30)
+PURGE_INTERVAL = 60
+
+
+class DenyList:
+    # Revoked tokens and users held in memory, checked on every request, written through to postgres and read back
+    # from it so a revocation on one worker reaches all of them within one sync interval
+
+    def __init__(self, *, sync_interval: float, token_lifetime: timedelta) -> None:
+        self.sync_interval = sync_interval
+        self.token_lifetime = token_lifetime
+
+        # jti -> expires, user id -> (revoked at, expires), as timestamps
+        self.tokens: dict[str, float] = {}
+        self.users: dict[UUID, tuple[float, float]] = {}
+
+        self.synced_at: datetime | None = None
+        self._purged = 0.0
+        self._syncer: asyncio.Task[None] | None = None
+
+    def __len__(self) -> int:
+        return len(self.tokens) + len(self.users)
+
+    def denied(self, token_user: TokenUser) -> bool:
+        if token_user.jti is not None and token_user.jti in self.tokens:
+            return True
+
+        revoked = self.users.get(token_user.id)
+        return revoked is not None and token_user.issued_at <= revoked[0]
+
+    def apply(self, revocation: RevocationBase) -> None:
+        expires = revocation.expires_at.timestamp()
+
+        if revocation.jti is not None:
+            self.tokens[revocation.jti] = expires
+
+        if revocation.user_id is not None:
+            revoked_at = revocation.revoked_at.timestamp()
+            current = self.users.get(revocation.user_id)
+            if current is None or current[0] < revoked_at:
+                self.users[revocation.user_id] = (revoked_at, expires)
+
+    def expire(self, now: float) -> None:
+        self.tokens = {jti: expires for jti, expires in self.tokens.items() if expires > now}
+        self.users = {ident: revoked for ident, revoked in self.users.items() if revoked[1] > now}
+
+    async def revoke(self, session: AsyncSession, revocations: Sequence[RevocationBase]) -> None:
+        # denied here straight away, the other workers pick them up on their next sync
+        for revocation in revocations:
+            self.apply(revocation)
+
+        await RevocationRepository(session=session).bulk_create(revocations)
+
+    async def revoke_token(self, session: AsyncSession, token_user: TokenUser) -> None:
+        if token_user.jti is None:
+            return
+
+        revocation = RevocationBase(
+            jti=token_user.jti,
+            revoked_at=datetime.now(UTC),
+            expires_at=datetime.fromtimestamp(token_user.expires_at, UTC),
+        )
+        await self.revoke(session, [revocation])
+
+    async def revoke_users(self, session: AsyncSession, idents: Iterable[UUID]) -> None:
+        # every token issued until now, none of them outlives the token lifetime
+        now = datetime.now(UTC)
+        revocations = [
+            RevocationBase(user_id=ident, revoked_at=now, expires_at=now + self.token_lifetime) for ident in idents
+        ]
+        await self.revoke(session, revocations)
+
+    async def sync(self) -> None:
+        now = datetime.now(UTC)
+        since = datetime.min.replace(tzinfo=UTC) if self.synced_at is None else self.synced_at - SYNC_OVERLAP
+
+        async with database.SessionLocal() as session:
+            # a replica lagging by more than SYNC_OVERLAP would skip revocations for good
+            database.use_primary(session)
+            repository = RevocationRepository(session=session)
+
+            for revocation in await repository.since(since):
+                self.apply(revocation)
+
+            if time.monotonic() - self._purged >= PURGE_INTERVAL:
+                self._purged = time.monotonic()
+                self.expire(now.timestamp())
+                await repository.purge(now)
+
+        self.synced_at = now
+
+    async def start(self) -> None:
+        if not self.sync_interval:
+            return
+
+        # the first sync runs before any request is served, a failure there is retried by the loop
+        try:
+            await self.sync()
+        except (OSError, SQLAlchemyError):
+            logger.exception('Failed to load the deny-list')
+
+        self._syncer = asyncio.create_task(self._sync_loop(), name='deny-list-sync')
+
+    async def stop(self) -> None:
+        if self._syncer is not None:
+            self._syncer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._syncer
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+
+            try:
+                await self.sync()
+            except (OSError, SQLAlchemyError):
+                logger.exception('Failed to sync the deny-list')
+
+
+deny_list = DenyList(
+    sync_interval=settings.DENY_LIST_SYNC_SECONDS,
+    token_lifetime=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
+)
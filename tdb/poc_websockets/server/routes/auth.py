@@ -1,15 +1,18 @@
+import math
 from datetime import timedelta
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
 from starlette.responses import Response
 
 from tdb.poc_websockets.server import auth, database
 from tdb.poc_websockets.server.config import settings
-from tdb.poc_websockets.server.models.auth_token import Logout, Token
+from tdb.poc_websockets.server.models.auth_token import Logout, Token, TokenUser
 from tdb.poc_websockets.server.models.user import User, UserRead, UserRepository
+from tdb.poc_websockets.server.ratelimit import limits
 
 router = APIRouter(
     prefix='/auth',
@@ -17,19 +20,38 @@ router = APIRouter(
 )
 
 
-@router.post('/login')
+async def limit_login(request: Request) -> None:
+    # checked before the form is parsed or bcrypt is queued
+    ip = request.client.host if request.client else 'unknown'
+
+    wait = limits.login.wait(ip)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Too many login attempts',
+            headers={'Retry-After': str(math.ceil(wait))},
+        )
+
+    limits.login.take(ip)
+
+
+async def get_user_repository(db: Annotated[AsyncSession, Depends(database.get_session)]) -> UserRepository:
+    return UserRepository(session=db)
+
+
+@router.post('/login', dependencies=[Depends(limit_login)])
 async def login_token(
     response: Response,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Annotated[AsyncSession, Depends(database.get_session)],
+    users: Annotated[UserRepository, Depends(get_user_repository)],
 ) -> Token:
-    user = await UserRepository(session=db).get_by_email(form_data.username)
+    user = await users.get_by_email(form_data.username)
 
-    if not auth.verify_password(form_data.password, user.password):
+    if not await auth.verify_password(form_data.password, user.password):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Invalid Credentials')
 
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = auth.create_access_token(data={'sub': user.email}, expires_delta=access_token_expires)
+    access_token = auth.create_access_token(user, expires_delta=access_token_expires)
 
     # set HttpOnly cookie in response
     response.set_cookie(
@@ -41,7 +63,15 @@ async def login_token(
 
 
 @router.delete('/logout')
-async def logout(response: Response) -> Logout:
+async def logout(
+    response: Response,
+    token: Annotated[str | None, Depends(auth.optional_bearer)],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> Logout:
+    # the token stays valid until it expires unless it is revoked, clearing the cookie alone does not end a session
+    if token is not None:
+        await auth.revoke_token(token, db)
+
     response.delete_cookie('access_token')
     return Logout()
 
@@ -52,5 +82,7 @@ async def current_user(user: Annotated[User, Depends(auth.get_current_active_use
 
 
 @router.get('/users/me/items/')
-async def read_own_items(user: Annotated[User, Depends(auth.get_current_active_user)]) -> list[dict[str, str]]:
+async def read_own_items(
+    user: Annotated[TokenUser, Depends(auth.get_current_active_claims)],
+) -> list[dict[str, str]]:
     return [{'item_id': 'Foo', 'owner': user.email}]
@@ -2,6 +2,8 @@ from fastapi import APIRouter
 from starlette.requests import Request
 from starlette.responses import HTMLResponse
 
+from tdb.poc_websockets.server import shards
+from tdb.poc_websockets.server.config import settings
 from tdb.poc_websockets.server.routes import templates
 
 router = APIRouter(
@@ -12,4 +14,9 @@ router = APIRouter(
 
 @router.get('/{room}')
 async def html_room(request: Request, room: str) -> HTMLResponse:
-    return templates.TemplateResponse('room.html.jinja', {'request': request, 'room': room})
+    ws_url = request.url_for('ws_room', room=room)
+    if settings.WS_SHARDS > 1:
+        # cookies are not scoped by port, the login cookie is sent to any shard
+        ws_url = ws_url.replace(port=shards.shard_port(shards.shard_for(room)))
+
+    return templates.TemplateResponse('room.html.jinja', {'request': request, 'room': room, 'ws_url': str(ws_url)})
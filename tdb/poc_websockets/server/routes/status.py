@@ -1,6 +1,17 @@
+import asyncio
+import logging
+import time
+
 from fastapi import APIRouter
 from pydantic import BaseModel
 from starlette import status
+from starlette.responses import Response
+
+from tdb.poc_websockets.server import database, health, metrics
+from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.websocket import manager
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix='/status',
@@ -12,6 +23,22 @@ class HealthCheck(BaseModel):
     status: bool
 
 
+class ReadinessCheck(HealthCheck):
+    loop_lag_ms: float
+    pool_usage: float
+    database: bool
+    broker: bool
+    connections: int
+    draining: bool
+
+
+class DrainStatus(BaseModel):
+    draining: bool
+    total: int
+    remaining: int
+    seconds_left: float
+
+
 @router.get(
     '/health',
     summary='Perform a Health Check',
@@ -20,3 +47,88 @@ class HealthCheck(BaseModel):
 )
 def get_health() -> HealthCheck:
     return HealthCheck(status=True)
+
+
+@router.get(
+    '/live',
+    summary='Perform a Liveness Check',
+    response_description='Return HTTP Status Code 200 (OK), or 503 when the event loop is stuck',
+    status_code=status.HTTP_200_OK,
+)
+async def get_live(response: Response) -> HealthCheck:
+    alive = health.loop_lag.running and health.loop_lag.lag * 1000 < settings.LIVE_MAX_LOOP_LAG_MS
+
+    if not alive:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return HealthCheck(status=alive)
+
+
+@router.get(
+    '/ready',
+    summary='Perform a Readiness Check',
+    response_description='Return HTTP Status Code 200 (OK), or 503 when this worker should not get new sockets',
+    status_code=status.HTTP_200_OK,
+)
+async def get_ready(response: Response) -> ReadinessCheck:
+    try:
+        async with asyncio.timeout(settings.READY_DB_TIMEOUT_MS / 1000):
+            database_ok = await health.database_reachable()
+
+    except TimeoutError:
+        logger.warning('Readiness database check timed out')
+        database_ok = False
+
+    check = ReadinessCheck(
+        status=False,
+        loop_lag_ms=health.loop_lag.lag * 1000,
+        pool_usage=database.pool_usage(),
+        database=database_ok,
+        broker=manager.broker.healthy,
+        connections=len(manager.registry),
+        draining=manager.draining,
+    )
+    check.status = (
+        check.loop_lag_ms < settings.READY_MAX_LOOP_LAG_MS
+        and check.pool_usage < settings.READY_MAX_POOL_USAGE
+        and check.database
+        and check.broker
+        and check.connections < settings.WS_MAX_CONNECTIONS
+        and not check.draining
+    )
+
+    if not check.status:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return check
+
+
+def drain_status() -> DrainStatus:
+    return DrainStatus(
+        draining=manager.draining,
+        total=manager.drain_total,
+        remaining=len(manager.registry) if manager.draining else 0,
+        seconds_left=max(0.0, manager.drain_deadline - time.monotonic()) if manager.draining else 0.0,
+    )
+
+
+@router.get(
+    '/drain',
+    summary='Websocket Drain Progress',
+    response_description='Sockets open when the drain started and still open now',
+    status_code=status.HTTP_200_OK,
+)
+async def get_drain() -> DrainStatus:
+    return drain_status()
+
+
+@router.get(
+    '/metrics',
+    summary='Prometheus Metrics',
+    response_description='Metrics in the Prometheus text exposition format',
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+)
+async def get_metrics() -> Response:
+    # async, so the scrape runs on the event loop that owns every metric
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
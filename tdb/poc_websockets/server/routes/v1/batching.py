@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
+
+from tdb.poc_websockets.server import auth
+from tdb.poc_websockets.server.config import settings
+from tdb.poc_websockets.server.websocket import manager
+
+# Per room micro-batching on this worker, WS_BATCH_ROOMS sets the rooms batched from startup
+router = APIRouter(
+    prefix='/v1/rooms',
+    tags=['rooms'],
+    dependencies=[Depends(auth.get_current_active_claims)],
+)
+
+
+class BatchingUpdate(BaseModel):
+    enabled: bool
+
+
+class RoomBatching(BatchingUpdate):
+    room: str
+    window_ms: float
+    max_messages: int
+
+
+def room_batching(room: str) -> RoomBatching:
+    return RoomBatching(
+        room=room,
+        enabled=room in manager.batched,
+        window_ms=settings.WS_BATCH_WINDOW_MS,
+        max_messages=settings.WS_BATCH_MAX_MESSAGES,
+    )
+
+
+@router.get(
+    '/{room}/batching',
+    summary='Get whether a Room delivers in batches',
+    status_code=status.HTTP_200_OK,
+)
+async def get_batching(room: str) -> RoomBatching:
+    return room_batching(room)
+
+
+@router.put(
+    '/{room}/batching',
+    summary='Turn batching on or off for a Room',
+    status_code=status.HTTP_200_OK,
+)
+async def put_batching(room: str, data: BatchingUpdate) -> RoomBatching:
+    # only rooms with members on this worker, arbitrary room names would pile up in the batched set
+    if data.enabled and room not in manager.registry.rooms:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'No members in room: {room}')
+
+    manager.set_batching(room, enabled=data.enabled)
+    return room_batching(room)
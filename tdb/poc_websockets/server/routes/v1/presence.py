@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, status
+from pydantic import BaseModel
+
+from tdb.poc_websockets.server import auth
+from tdb.poc_websockets.server.websocket import manager
+
+# Presence as seen by this worker, answered from the registry indexes without scanning every room. Members are
+# identified by email, only signed in users may look them up.
+router = APIRouter(
+    prefix='/v1/presence',
+    tags=['presence'],
+    dependencies=[Depends(auth.get_current_active_claims)],
+)
+
+
+class RoomPresence(BaseModel):
+    room: str
+    users: list[str]
+    connections: int
+
+
+class UserPresence(BaseModel):
+    user: str
+    rooms: list[str]
+    connections: int
+
+
+@router.get(
+    '/rooms/{room}',
+    summary='Get the Users in a Room',
+    status_code=status.HTTP_200_OK,
+)
+async def get_room(room: str) -> RoomPresence:
+    connections = manager.registry.room(room)
+    return RoomPresence(
+        room=room,
+        users=sorted({connection.user for connection in connections}),
+        connections=len(connections),
+    )
+
+
+@router.get(
+    '/users/{user}',
+    summary='Get the Rooms a User is in',
+    status_code=status.HTTP_200_OK,
+)
+async def get_user(user: str) -> UserPresence:
+    connections = manager.registry.user(user)
+    return UserPresence(
+        user=user,
+        rooms=sorted({connection.room for connection in connections}),
+        connections=len(connections),
+    )
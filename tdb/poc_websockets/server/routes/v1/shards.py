@@ -0,0 +1,28 @@
+from fastapi import APIRouter, status
+from pydantic import BaseModel
+
+from tdb.poc_websockets.server import shards
+from tdb.poc_websockets.server.config import settings
+
+# Where a Room's websockets are served, clients connect to the shard's port, see shards
+router = APIRouter(
+    prefix='/v1/rooms',
+    tags=['rooms'],
+)
+
+
+class RoomShard(BaseModel):
+    room: str
+    shard: int
+    shards: int
+    port: int
+
+
+@router.get(
+    '/{room}/shard',
+    summary='Get the shard serving a Room',
+    status_code=status.HTTP_200_OK,
+)
+async def get_shard(room: str) -> RoomShard:
+    shard = shards.shard_for(room)
+    return RoomShard(room=room, shard=shard, shards=settings.WS_SHARDS, port=shards.shard_port(shard))
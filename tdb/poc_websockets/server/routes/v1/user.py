@@ -1,19 +1,24 @@
 import logging
+from collections.abc import AsyncIterator
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import StreamingResponse
 
 from tdb.poc_websockets.server import database
 from tdb.poc_websockets.server.models import DeleteResponse
-from tdb.poc_websockets.server.models.user import UserCreate, UserRead, UserRepository, UserUpdate
+from tdb.poc_websockets.server.models.user import UserCreate, UserPage, UserRead, UserRepository, UserUpdate
 
 router = APIRouter(
     prefix='/v1/users',
     tags=['users'],
 )
 
+# rows fetched from the server side cursor, and written to the response, at a time
+EXPORT_PARTITION = 1_000
+
 
 @router.post(
     '/',
@@ -26,6 +31,77 @@ async def post(data: UserCreate, db: Annotated[AsyncSession, Depends(database.ge
     return UserRead.model_validate(model)
 
 
+@router.get(
+    '/',
+    summary='List Users, optionally by name prefix',
+    status_code=status.HTTP_200_OK,
+)
+async def get_list(
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+    name: str | None = None,
+    after: UUID | None = None,
+    limit: Annotated[int, Query(ge=1, le=1_000)] = 100,
+) -> UserPage:
+    models = await UserRepository(session=db).page(limit=limit, name=name, after=after)
+    users = [UserRead.model_validate(model) for model in models]
+    return UserPage(users=users, cursor=users[-1].id if len(users) == limit else None)
+
+
+@router.get(
+    '/export',
+    summary='Export Users as NDJSON, optionally by name prefix',
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def get_export(name: str | None = None) -> StreamingResponse:
+    async def lines() -> AsyncIterator[str]:
+        # its own session, the response outlives the request's dependencies
+        async with database.SessionLocal() as session:
+            async for models in UserRepository(session=session).stream(partition=EXPORT_PARTITION, name=name):
+                yield ''.join(UserRead.model_validate(model).model_dump_json() + '\n' for model in models)
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+@router.post(
+    '/bulk',
+    summary='Create Users in bulk',
+    status_code=status.HTTP_201_CREATED,
+)
+async def post_bulk(
+    data: list[UserCreate],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> list[UserRead]:
+    models = await UserRepository(session=db).bulk_create(data)
+    return [UserRead.model_validate(model) for model in models]
+
+
+@router.patch(
+    '/bulk',
+    summary='Update Users in bulk, keyed by id',
+    status_code=status.HTTP_200_OK,
+)
+async def patch_bulk(
+    data: dict[UUID, UserUpdate],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> list[UserRead]:
+    models = await UserRepository(session=db).bulk_update(data)
+    return [UserRead.model_validate(model) for model in models]
+
+
+@router.delete(
+    '/bulk',
+    summary='Delete Users in bulk',
+    status_code=status.HTTP_200_OK,
+)
+async def delete_bulk(
+    data: list[UUID],
+    db: Annotated[AsyncSession, Depends(database.get_session)],
+) -> DeleteResponse:
+    deleted = await UserRepository(session=db).bulk_delete(data)
+    return DeleteResponse(deleted=len(deleted))
+
+
 @router.get(
     '/{ident}',
     summary='Get a User',
@@ -1,10 +1,22 @@
+import asyncio
+import logging
+import struct
+import time
+import zlib
 from typing import Annotated
+from uuid import UUID
 
-from fastapi import APIRouter, Cookie, Depends, WebSocket, WebSocketDisconnect
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Cookie, WebSocket, WebSocketDisconnect
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1012_SERVICE_RESTART, WS_1013_TRY_AGAIN_LATER
 
-from tdb.poc_websockets.server import auth, database
-from tdb.poc_websockets.server.websocket import manager
+from tdb.poc_websockets.server import auth, metrics, protocol, shards
+from tdb.poc_websockets.server.config import RateLimitMode, settings
+from tdb.poc_websockets.server.models.auth_token import TokenUser
+from tdb.poc_websockets.server.protocol import SUBPROTOCOL, SUBPROTOCOL_DEFLATE, Envelope, Kind, WireFormat
+from tdb.poc_websockets.server.ratelimit import limits
+from tdb.poc_websockets.server.websocket import Connection, manager
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix='/websocket',
@@ -12,28 +24,142 @@ router = APIRouter(
 )
 
 
+async def admit(socket: WebSocket, room: str, access_token: str) -> TokenUser | None:
+    # the user the socket is opened for, or None once a refused socket is closed
+    if manager.draining:
+        await socket.close(code=WS_1012_SERVICE_RESTART)
+        return None
+
+    # the room's members all live in its shard's process, see shards
+    if not shards.owns(room):
+        logger.warning('Rejecting websocket for %s, owned by shard %d', room, shards.shard_for(room))
+        await socket.close(code=WS_1008_POLICY_VIOLATION)
+        return None
+
+    if len(manager.registry) >= settings.WS_MAX_CONNECTIONS:
+        logger.warning('Rejecting websocket, %d connections open', len(manager.registry))
+        await socket.close(code=WS_1013_TRY_AGAIN_LATER)
+        return None
+
+    # disabling a user revokes its tokens, which the deny-list refuses here on every worker, the claim only covers
+    # tokens issued while already disabled
+    token = access_token.split('Bearer')[1].strip()
+    current_user = await auth.get_websocket_user(token)
+    if current_user.disabled:
+        await socket.close(code=WS_1008_POLICY_VIOLATION)
+        return None
+
+    return current_user
+
+
+def negotiate(socket: WebSocket) -> tuple[WireFormat, str | None]:
+    # text stays the default, clients opt in to binary envelopes, deflated ones preferred when offered
+    offered = socket.scope.get('subprotocols', [])
+    if settings.WS_ENVELOPE_DEFLATE and SUBPROTOCOL_DEFLATE in offered:
+        return WireFormat.DEFLATE, SUBPROTOCOL_DEFLATE
+
+    if SUBPROTOCOL in offered:
+        return WireFormat.BINARY, SUBPROTOCOL
+
+    return WireFormat.TEXT, None
+
+
+async def receive(socket: WebSocket, connection: Connection, *, sender_id: UUID) -> Envelope | None:
+    # the next message from the client, None for a frame that carries none
+    if not connection.wire_format.envelopes:
+        text = await socket.receive_text()
+        connection.last_seen = time.monotonic()
+
+        return Envelope.message(text.encode('utf-8'), room=connection.room, sender=connection.user, sender_id=sender_id)
+
+    data = await socket.receive_bytes()
+    connection.last_seen = time.monotonic()
+
+    try:
+        if connection.wire_format is WireFormat.DEFLATE:
+            data = protocol.inflate(data)
+
+        inbound = protocol.decode(data)
+    except (struct.error, zlib.error, ValueError):
+        logger.warning('Dropping malformed envelope from %s', connection.user)
+        return None
+
+    if inbound.kind is not Kind.MESSAGE:
+        return None
+
+    # only the payload is taken from the client
+    return Envelope.message(inbound.payload, room=connection.room, sender=connection.user, sender_id=sender_id)
+
+
+async def rate_limit(connection: Connection, *, ip: str) -> bool:
+    # every message is amplified by the room size, limit before it reaches broadcast, False drops the message
+    user, room = connection.user, connection.room
+
+    wait = limits.wait(user=user, room=room, ip=ip)
+    if wait and limits.mode is RateLimitMode.DROP:
+        metrics.websocket_messages_limited.inc()
+
+        if time.monotonic() - connection.last_notice >= 1:
+            connection.last_notice = time.monotonic()
+            notice = Envelope.system(f'Rate limit exceeded, retry in {wait:.2f}s', room=room)
+            await manager.send_message(notice, connection=connection)
+
+        return False
+
+    if wait:
+        # stop reading from this client until its buckets refill, tcp pushes back on the sender
+        metrics.websocket_messages_limited.inc()
+        await asyncio.sleep(wait)
+
+    limits.take(user=user, room=room, ip=ip)
+    return True
+
+
 @router.websocket('/{room}')
 async def ws_room(
     socket: WebSocket,
     room: str,
     access_token: Annotated[str, Cookie()],
-    db: Annotated[AsyncSession, Depends(database.get_session)],
+    resume_from: int | None = None,
+    epoch: str | None = None,
 ) -> None:
-    token = access_token.split('Bearer')[1].strip()
-    current_user = await auth.get_current_user(token, db)
+    current_user = await admit(socket, room, access_token)
+    if current_user is None:
+        return
+
     email = current_user.email
+    ip = socket.client.host if socket.client else 'unknown'
+    wire_format, subprotocol = negotiate(socket)
 
-    await manager.connect(socket, room=room, user=email)
+    connection = await manager.connect(
+        socket,
+        room=room,
+        user=email,
+        wire_format=wire_format,
+        subprotocol=subprotocol,
+        resume_from=resume_from,
+        epoch=epoch,
+    )
 
-    await manager.send_message(f'You ({email}) joined room: {room}', room=room, user=email)
-    await manager.broadcast(f'User {email} joined room: {room}', room=room, sending_user=email)
+    await manager.send_message(Envelope.system(f'You ({email}) joined room: {room}', room=room), connection=connection)
+    joined = Envelope.system(f'User {email} joined room: {room}', room=room, sender=email)
+    await manager.broadcast(joined, origin=connection)
 
     try:
         while True:
-            data = await socket.receive_text()
-            msg = f'{email}: {data}'
-            await manager.broadcast(msg, room=room, sending_user=email)
+            msg = await receive(socket, connection, sender_id=current_user.id)
+            if msg is None:
+                continue
+
+            metrics.websocket_messages_in.inc()
+
+            if await rate_limit(connection, ip=ip):
+                await manager.broadcast(msg, origin=connection)
 
     except WebSocketDisconnect:
-        manager.disconnect(room=room, user=email)
-        await manager.broadcast(f'User {email} left room: {room}', room=room, sending_user=email)
+        pass
+
+    finally:
+        # also reached on a frame of the wrong type or a socket already closed by the server, e.g. while draining
+        await manager.disconnect(connection)
+        await manager.broadcast(Envelope.system(f'User {email} left room: {room}', room=room, sender=email))
@@ -0,0 +1,22 @@
+import hashlib
+
+from tdb.poc_websockets.server.config import settings
+
+# Rooms are spread over WS_SHARDS server processes, shard i listening on APP_PORT + i. Every member of a room connects
+# to the room's shard, so its fan-out never leaves the process, while different rooms run on different cores.
+
+
+def shard_for(room: str, shards: int = settings.WS_SHARDS) -> int:
+    if shards <= 1:
+        return 0
+
+    # rendezvous hashing, changing the shard count only moves the rooms of the shards added or removed
+    return max(range(shards), key=lambda shard: hashlib.blake2b(f'{shard}:{room}'.encode(), digest_size=8).digest())
+
+
+def shard_port(shard: int) -> int:
+    return settings.APP_PORT + shard
+
+
+def owns(room: str) -> bool:
+    return shard_for(room) == settings.WS_SHARD
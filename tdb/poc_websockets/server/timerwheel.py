@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import logging
+import math
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ('callback', 'cancelled', 'rounds')
+
+    def __init__(self, callback: Callable[[], None], rounds: int) -> None:
+        self.callback = callback
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class TimerWheel:
+    # Hashed timer wheel, one task ticks every timer instead of a sleeping task per timer.
+    # Timers fire on the first tick at or after their delay, so `tick` is the resolution.
+
+    def __init__(self, *, tick: float, slots: int) -> None:
+        self.tick = tick
+        self.slots: list[list[Timer]] = [[] for _ in range(slots)]
+        self.cursor = 0
+        self._task: asyncio.Task[None] | None = None
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> Timer:
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(callback, (ticks - 1) // len(self.slots))
+
+        self.slots[(self.cursor + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name='timer-wheel')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick
+
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+            # catch up on ticks missed while the loop was busy
+            while next_tick <= loop.time():
+                self._advance()
+                next_tick += self.tick
+
+    def _advance(self) -> None:
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+        due, self.slots[self.cursor] = self.slots[self.cursor], []
+        for timer in due:
+            if timer.cancelled:
+                continue
+
+            if timer.rounds:
+                timer.rounds -= 1
+                self.slots[self.cursor].append(timer)
+                continue
+
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception('Timer callback failed')
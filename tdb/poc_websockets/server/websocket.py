@@ -1,31 +1,617 @@
+import asyncio
+import contextlib
+import dataclasses
+import itertools
+import json
+import logging
+import secrets
+import time
 from collections import defaultdict
+from collections.abc import Collection, Iterator
 
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.status import WS_1001_GOING_AWAY, WS_1012_SERVICE_RESTART, WS_1013_TRY_AGAIN_LATER
+from starlette.websockets import WebSocketState
 
+from tdb.poc_websockets.server import metrics
+from tdb.poc_websockets.server.broker import Broker, create_broker
+from tdb.poc_websockets.server.config import SlowConsumerPolicy, settings
+from tdb.poc_websockets.server.history import MessageHistory, create_history
+from tdb.poc_websockets.server.protocol import Envelope, Kind, WireFormat, deflate, encode
+from tdb.poc_websockets.server.timerwheel import TimerWheel
 
-class ConnectionManager:
+logger = logging.getLogger(__name__)
+
+# A message already encoded for the wire, str for text frames and bytes for binary frames
+Frame = str | bytes
+
+
+def encode_frame(message: Envelope, wire_format: WireFormat) -> Frame:
+    if wire_format is WireFormat.BINARY:
+        return encode(message)
+
+    if wire_format is WireFormat.DEFLATE:
+        # compressed here, once per broadcast, rather than by permessage-deflate once per recipient
+        level = settings.WS_COMPRESSION_LEVEL
+        return deflate(encode(message), min_size=settings.WS_COMPRESSION_MIN_SIZE, level=level)
+
+    return message.text()
+
+
+def encode_batch(messages: list[Envelope], wire_format: WireFormat) -> Frame:
+    if wire_format.envelopes:
+        return encode_frame(Envelope.batch(messages, room=messages[0].room), wire_format)
+
+    # a json array of the text frames, never ambiguous as text messages always start with the sender
+    return json.dumps([message.text() for message in messages])
+
+
+def acknowledge(message: Envelope, wire_format: WireFormat) -> Envelope | None:
+    # what the sender of a message gets instead of it, envelope clients track sequence numbers and would see a gap
+    if message.seq and wire_format.envelopes:
+        return Envelope.control(Kind.ACK, room=message.room, seq=message.seq)
+
+    return None
+
+
+# process wide connection ids, cheaper to hash and compare than the socket or the user's email
+_ids = itertools.count(1)
+
+
+class Connection:
+    __slots__ = (
+        '_closer',
+        '_writer',
+        'closed',
+        'dropped',
+        'id',
+        'last_notice',
+        'last_seen',
+        'policy',
+        'queue',
+        'replayed_to',
+        'room',
+        'user',
+        'websocket',
+        'wire_format',
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        /,
+        *,
+        room: str,
+        user: str,
+        wire_format: WireFormat,
+        queue_size: int,
+        policy: SlowConsumerPolicy,
+    ) -> None:
+        self.id = next(_ids)
+        self.websocket = websocket
+        self.room = room
+        self.user = user
+        self.wire_format = wire_format
+        self.policy = policy
+
+        # last time anything, pongs included, was received from the client
+        self.last_seen = time.monotonic()
+        # last time the client was told it is being rate limited
+        self.last_notice = 0.0
+        # sequence number the connection was replayed up to when it joined, later messages are delivered to it
+        self.replayed_to = 0
+
+        # Outbound messages, drained by a single writer task per connection
+        self.queue: asyncio.Queue[Frame] = asyncio.Queue(queue_size)
+        self.dropped = 0
+        self.closed = False
+
+        self._writer: asyncio.Task[None] | None = None
+        self._closer: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write(), name=f'websocket-writer:{self.id}')
+
+    def stop(self) -> None:
+        self.closed = True
+
+        if self._writer is not None:
+            self._writer.cancel()
+
+    def close(self, code: int) -> None:
+        if self.closed:
+            return
+
+        self.stop()
+        self._closer = asyncio.create_task(self._close(code), name=f'websocket-closer:{self.id}')
+
+    def finish(self, code: int) -> None:
+        # stop taking messages and close once everything already queued is written
+        if self.closed:
+            return
+
+        self.closed = True
+        self._closer = asyncio.create_task(self._finish(code), name=f'websocket-closer:{self.id}')
+
+    def enqueue(self, message: Frame) -> None:
+        if self.closed:
+            return
+
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self._overflow(message)
+
+    def _overflow(self, message: Frame) -> None:
+        self.dropped += 1
+        metrics.websocket_messages_dropped.inc()
+
+        match self.policy:
+            case SlowConsumerPolicy.DROP_OLDEST:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.queue.put_nowait(message)
+
+            case SlowConsumerPolicy.DROP_NEWEST:
+                pass
+
+            case SlowConsumerPolicy.DISCONNECT:
+                logger.warning('Disconnecting slow consumer: %s', self.user)
+                self.close(WS_1013_TRY_AGAIN_LATER)
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                message = await self.queue.get()
+
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+
+                self.queue.task_done()
+
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            logger.debug('Writer stopped, websocket closed: %s', self.user)
+            self.closed = True
+
+    async def _finish(self, code: int) -> None:
+        if self._writer is not None:
+            # the writer stops early when the peer is already gone
+            flushed = asyncio.create_task(self.queue.join())
+            await asyncio.wait((flushed, self._writer), return_when=asyncio.FIRST_COMPLETED)
+            flushed.cancel()
+
+        self.stop()
+        await self._close(code)
+
+    async def _close(self, code: int) -> None:
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            with contextlib.suppress(RuntimeError, OSError):
+                await self.websocket.close(code=code)
+
+
+class ConnectionRegistry:
+    # Local connections indexed by room and by user, a user may be in a room from several devices
     def __init__(self) -> None:
-        # WebSockets by room and user
-        self.active_connections: dict[str, dict[str, WebSocket]] = defaultdict(lambda: defaultdict())
+        self.rooms: dict[str, dict[int, Connection]] = {}
+        self.users: dict[str, dict[int, Connection]] = {}
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Connection]:
+        for members in self.rooms.values():
+            yield from members.values()
+
+    def add(self, connection: Connection) -> bool:
+        # True when this is the room's first local connection
+        members = self.rooms.get(connection.room)
+        created = members is None
+        if members is None:
+            members = self.rooms[connection.room] = {}
+
+        members[connection.id] = connection
+        self.users.setdefault(connection.user, {})[connection.id] = connection
+        self.count += 1
+
+        return created
+
+    def remove(self, connection: Connection) -> bool:
+        # True when this was the room's last local connection, empty rooms and users are dropped
+        members = self.rooms.get(connection.room)
+        if members is None or members.pop(connection.id, None) is None:
+            return False
+
+        self.count -= 1
+
+        devices = self.users[connection.user]
+        del devices[connection.id]
+        if not devices:
+            del self.users[connection.user]
+
+        if members:
+            return False
+
+        del self.rooms[connection.room]
+        return True
+
+    def room(self, room: str) -> Collection[Connection]:
+        return self.rooms.get(room, {}).values()
+
+    def user(self, user: str) -> Collection[Connection]:
+        return self.users.get(user, {}).values()
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        broker: Broker,
+        history: MessageHistory,
+        /,
+        *,
+        queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+        policy: SlowConsumerPolicy = settings.WS_SLOW_CONSUMER_POLICY,
+    ) -> None:
+        self.queue_size = queue_size
+        self.policy = policy
+
+        # messages published by other processes are delivered to our local members
+        self.broker = broker
+        self.broker.set_handler(self.relay)
+
+        self.history = history
+
+        # one wheel drives every connection's heartbeat
+        self.timers = TimerWheel(tick=settings.TIMER_WHEEL_TICK_MS / 1000, slots=settings.TIMER_WHEEL_SLOTS)
+
+        self.registry = ConnectionRegistry()
+        # Last sequence number delivered to this process's members, by room. A room emptied and joined again carries on
+        # from the highest number issued before, so a resume_from from before it emptied is never taken as current.
+        self.sequence_floor = 0
+        self.sequences: dict[str, int] = defaultdict(lambda: self.sequence_floor)
+        # sequence numbers are only comparable within one epoch, a restarted process starts a new one
+        self.epoch = secrets.token_hex(8)
+
+        # Rooms delivering in batches, and the messages, with the connection they came from, waiting for their window
+        self.batched: set[str] = set()
+        self.batches: dict[str, list[tuple[Envelope, Connection | None]]] = {}
+        self._batch_timers: dict[str, asyncio.TimerHandle] = {}
+        for room in settings.WS_BATCH_ROOMS:
+            self.set_batching(room, enabled=True)
+
+        # set once draining starts, new sockets are refused from then on
+        self.draining = False
+        self.drain_total = 0
+        self.drain_deadline = 0.0
+        self._drain: asyncio.Task[None] | None = None
+        # set by the disconnect that leaves no connection while draining
+        self._drained = asyncio.Event()
+
+        self._evictions: set[asyncio.Task[None]] = set()
+
+    async def start(self) -> None:
+        await self.broker.start()
+        await self.history.start()
+        self.timers.start()
+
+    async def stop(self) -> None:
+        for room in list(self.batches):
+            self.flush_batch(room)
+
+        await self.timers.stop()
+        await self.broker.stop()
+        await self.history.stop()
 
     # make connection
-    async def connect(self, websocket: WebSocket, /, *, room: str, user: str) -> None:
-        await websocket.accept()
+    async def connect(
+        self,
+        websocket: WebSocket,
+        /,
+        *,
+        room: str,
+        user: str,
+        wire_format: WireFormat = WireFormat.TEXT,
+        subprotocol: str | None = None,
+        resume_from: int | None = None,
+        epoch: str | None = None,
+    ) -> Connection:
+        await websocket.accept(subprotocol=subprotocol)
+
+        connection = Connection(
+            websocket,
+            room=room,
+            user=user,
+            wire_format=wire_format,
+            queue_size=self.queue_size,
+            policy=self.policy,
+        )
+        connection.start()
+
+        # not registered yet, so nothing else would stop the writer if these fail
+        try:
+            # only listen for rooms with local members
+            if room not in self.registry.rooms:
+                await self.broker.subscribe(room)
+
+            recent = await self.history.recent(room)
+        except BaseException:
+            await self.disconnect(connection)
+            raise
+
+        replay = self.resume(room, resume_from, epoch)
+        if replay is None:
+            if resume_from is not None and wire_format.envelopes:
+                connection.enqueue(encode_frame(Envelope.control(Kind.RESYNC, room=room), wire_format))
+
+            replay = recent
+
+        # nothing awaits between the replay and registering, so no message is missed or repeated
+        for message in replay:
+            connection.enqueue(encode_frame(message, wire_format))
+
+        connection.replayed_to = self.sequences[room]
+        if wire_format.envelopes:
+            sync = Envelope.control(Kind.SYNC, room=room, seq=self.sequences[room], payload=self.epoch.encode('ascii'))
+            connection.enqueue(encode_frame(sync, wire_format))
+
+        self.registry.add(connection)
+        self.timers.schedule(settings.WS_HEARTBEAT_INTERVAL_SECONDS, lambda: self.heartbeat(connection))
+
+        return connection
+
+    def heartbeat(self, connection: Connection) -> None:
+        if connection.closed:
+            return
+
+        idle = time.monotonic() - connection.last_seen
+        if connection.wire_format.envelopes:
+            timeout = settings.WS_IDLE_TIMEOUT_SECONDS
+        else:
+            # text clients never pong, they rely on the server's protocol level pings
+            timeout = settings.WS_TEXT_IDLE_TIMEOUT_SECONDS
+
+        if timeout and idle > timeout:
+            logger.info('Evicting idle websocket %s in %s after %.0fs', connection.user, connection.room, idle)
+            metrics.websocket_idle_evictions.inc()
+
+            connection.close(WS_1001_GOING_AWAY)
+            # a dead peer may never complete the close handshake, free the room slot now
+            eviction = asyncio.create_task(self.disconnect(connection))
+            eviction.add_done_callback(self._evictions.discard)
+            self._evictions.add(eviction)
+            return
+
+        if connection.wire_format.envelopes:
+            ping = Envelope.control(Kind.PING, room=connection.room)
+            connection.enqueue(encode_frame(ping, connection.wire_format))
+
+        self.timers.schedule(settings.WS_HEARTBEAT_INTERVAL_SECONDS, lambda: self.heartbeat(connection))
+
+    def resume(self, room: str, resume_from: int | None, epoch: str | None) -> list[Envelope] | None:
+        # the gap since resume_from, or None when it is no longer fully inside the replay window
+        if resume_from is None or epoch != self.epoch or resume_from > self.sequences[room]:
+            return None
+
+        missed = self.history.since(room, resume_from)
+        if len(missed) != self.sequences[room] - resume_from:
+            return None
+
+        return missed
+
+    async def disconnect(self, connection: Connection, /) -> None:
+        connection.stop()
+
+        # an evicted connection is removed once, by whichever of eviction or the reader gets here first
+        if self.registry.remove(connection):
+            self.history.forget(connection.room)
+            self.sequence_floor = max(self.sequence_floor, self.sequences.pop(connection.room, 0))
+            await self.broker.unsubscribe(connection.room)
+
+        if self.draining and not self.registry:
+            self._drained.set()
+
+    async def send_message(self, message: Envelope, /, *, connection: Connection) -> None:
+        connection.enqueue(encode_frame(message, connection.wire_format))
+
+    async def broadcast(self, message: Envelope, /, *, origin: Connection | None = None) -> None:
+        # numbered, and given the id it is stored under, as it is received, only the receiving process stores it
+        message = self.sequence(message)
+        if message.kind is Kind.MESSAGE:
+            self.history.persist(message)
+
+        self.deliver(message, origin=origin)
+        await self.broker.publish(message)
+
+    def relay(self, message: Envelope, /) -> None:
+        # published by another process, renumbered in this one's sequence
+        if message.room in self.registry.rooms:
+            self.deliver(self.sequence(message))
+
+    def deliver(self, message: Envelope, /, *, origin: Connection | None = None) -> None:
+        connections = self.registry.rooms.get(message.room)
+        if not connections:
+            return
+
+        if message.room in self.batched:
+            self.batch(message, origin)
+            return
+
+        start = time.perf_counter()
+
+        # encoded once per wire format, every recipient shares the same buffer
+        frames: dict[WireFormat, Frame] = {}
+        recipients = 0
+
+        # never awaits a client, slow consumers are handled by their own queue policy
+        for connection in connections.values():
+            # the sender's other devices still get the message
+            if connection is origin:
+                ack = acknowledge(message, connection.wire_format)
+                if ack is not None:
+                    connection.enqueue(encode_frame(ack, connection.wire_format))
+
+                continue
+
+            frame = frames.get(connection.wire_format)
+            if frame is None:
+                frame = frames[connection.wire_format] = encode_frame(message, connection.wire_format)
+
+            connection.enqueue(frame)
+            recipients += 1
+
+        metrics.broadcast_fanout_seconds.observe(time.perf_counter() - start)
+        metrics.websocket_messages_out.inc(recipients)
+
+    def start_drain(
+        self,
+        *,
+        timeout: float = settings.DRAIN_TIMEOUT_SECONDS,
+        spread: float = settings.DRAIN_RECONNECT_SPREAD_SECONDS,
+    ) -> asyncio.Task[None]:
+        if self._drain is None:
+            # set before the task first runs, a status read right after starting already reports the drain
+            self.draining = True
+            self.drain_total = len(self.registry)
+            self.drain_deadline = time.monotonic() + timeout
+            metrics.websocket_draining.set(1)
+            logger.info('Draining %d websockets within %.0fs', self.drain_total, timeout)
+
+            self._drain = asyncio.create_task(self._run_drain(spread), name='websocket-drain')
+
+        return self._drain
+
+    async def _run_drain(self, spread: float) -> None:
+        for room in list(self.batches):
+            self.flush_batch(room)
+
+        # spread out over the window, so the surviving workers are not hit by every login at once
+        random = secrets.SystemRandom()
+        for connection in list(self.registry):
+            delay = random.uniform(0, spread)
+
+            if connection.wire_format.envelopes:
+                notice = Envelope.control(Kind.RECONNECT, room=connection.room, payload=f'{delay:.3f}'.encode('ascii'))
+            else:
+                notice = Envelope.system(f'Server is restarting, reconnect in {delay:.1f}s', room=connection.room)
+
+            connection.enqueue(encode_frame(notice, connection.wire_format))
+            connection.finish(WS_1012_SERVICE_RESTART)
+
+        if self.registry:
+            with contextlib.suppress(TimeoutError):
+                async with asyncio.timeout(max(0.0, self.drain_deadline - time.monotonic())):
+                    await self._drained.wait()
+
+        for connection in list(self.registry):
+            logger.warning('Drain deadline passed, dropping websocket %s in %s', connection.user, connection.room)
+            connection.stop()
+            await self.disconnect(connection)
+
+        logger.info('Drained %d websockets', self.drain_total)
+
+    def sequence(self, message: Envelope) -> Envelope:
+        if message.kind is not Kind.MESSAGE:
+            return message
+
+        self.sequences[message.room] += 1
+        message = dataclasses.replace(message, seq=self.sequences[message.room])
+        self.history.remember(message)
+
+        return message
+
+    def set_batching(self, room: str, *, enabled: bool) -> None:
+        if enabled:
+            self.batched.add(room)
+        else:
+            self.batched.discard(room)
+            self.flush_batch(room)
+
+        metrics.websocket_batched_rooms.set(len(self.batched))
+
+    def batch(self, message: Envelope, origin: Connection | None) -> None:
+        batch = self.batches.setdefault(message.room, [])
+        batch.append((message, origin))
+
+        if len(batch) >= settings.WS_BATCH_MAX_MESSAGES:
+            self.flush_batch(message.room)
+        elif len(batch) == 1:
+            loop = asyncio.get_running_loop()
+            self._batch_timers[message.room] = loop.call_later(
+                settings.WS_BATCH_WINDOW_MS / 1000,
+                self.flush_batch,
+                message.room,
+            )
+
+    def flush_batch(self, room: str) -> None:
+        timer = self._batch_timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.batches.pop(room, None)
+        connections = self.registry.rooms.get(room)
+        if not batch or not connections:
+            return
+
+        messages = [message for message, _ in batch]
+        origins = {origin for _, origin in batch if origin is not None}
+        # members that joined inside the window were already replayed the messages numbered up to their sync
+        first = next((message.seq for message in messages if message.seq), None)
+
+        start = time.perf_counter()
+
+        frames: dict[WireFormat, Frame] = {}
+        recipients = 0
+
+        for connection in connections.values():
+            if connection in origins or (first is not None and connection.replayed_to >= first):
+                # senders get their own copy without their own messages, there are at most as many as messages
+                others = self.unseen(batch, connection)
+                if others:
+                    connection.enqueue(encode_batch(others, connection.wire_format))
+                    recipients += 1
+
+                continue
+
+            frame = frames.get(connection.wire_format)
+            if frame is None:
+                frame = frames[connection.wire_format] = encode_batch(messages, connection.wire_format)
+
+            connection.enqueue(frame)
+            recipients += 1
+
+        metrics.broadcast_fanout_seconds.observe(time.perf_counter() - start)
+        metrics.websocket_messages_out.inc(recipients)
+        metrics.websocket_batches.inc()
+        metrics.websocket_batch_size.observe(len(messages))
+
+    def unseen(self, batch: list[tuple[Envelope, Connection | None]], connection: Connection) -> list[Envelope]:
+        messages = []
+        for message, origin in batch:
+            if 0 < message.seq <= connection.replayed_to:
+                continue
+
+            if origin is not connection:
+                messages.append(message)
+            elif (ack := acknowledge(message, connection.wire_format)) is not None:
+                messages.append(ack)
 
-        self.active_connections[room][user] = websocket
+        return messages
 
-    def disconnect(self, /, *, room: str, user: str) -> None:
-        self.active_connections[room].pop(user)
+    def connection_count(self) -> dict[metrics.Labels, float]:
+        return {(): self.registry.count}
 
-    async def send_message(self, message: str, /, *, room: str, user: str) -> None:
-        websocket = self.active_connections[room][user]
+    def room_count(self) -> dict[metrics.Labels, float]:
+        return {(): len(self.registry.rooms)}
 
-        await websocket.send_text(message)
+    def queue_depths(self) -> dict[metrics.Labels, float]:
+        depths = [connection.queue.qsize() for room in self.registry.rooms.values() for connection in room.values()]
+        return {('total',): sum(depths), ('max',): max(depths, default=0)}
 
-    async def broadcast(self, message: str, /, *, room: str, sending_user: str) -> None:
-        for user, websocket in self.active_connections[room].items():
-            if user != sending_user:
-                await websocket.send_text(message)
 
+manager = ConnectionManager(create_broker(), create_history())
 
-manager = ConnectionManager()
+metrics.websocket_connections.collect = manager.connection_count
+metrics.websocket_rooms.collect = manager.room_count
+metrics.websocket_send_queue_depth.collect = manager.queue_depths
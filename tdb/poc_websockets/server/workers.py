@@ -0,0 +1,51 @@
+import asyncio
+import functools
+import logging
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import ParamSpec, TypeVar
+
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+logger = logging.getLogger(__name__)
+
+Params = ParamSpec('Params')
+Result = TypeVar('Result')
+
+
+class PoolSaturatedError(HTTPException):
+    def __init__(self, name: str) -> None:
+        super().__init__(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f'{name} is busy, try again later',
+            headers={'Retry-After': '1'},
+        )
+
+
+class BoundedExecutor:
+    # Runs blocking calls off the event loop, at most `max_workers` at once
+    # and rejecting work once `max_pending` calls are running or queued.
+
+    def __init__(self, name: str, *, max_workers: int, max_pending: int) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    async def run(self, func: Callable[Params, Result], *args: Params.args, **kwargs: Params.kwargs) -> Result:
+        if self.pending >= self.max_pending:
+            logger.warning('%s saturated, %d calls pending', self.name, self.pending)
+            raise PoolSaturatedError(self.name)
+
+        self.pending += 1
+        try:
+            call = functools.partial(func, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)